@@ -0,0 +1,247 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2013, Jeremie Le Hen <jeremie@le-hen.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Times the TodoDatabase operations against a synthetic database and saves
+# the results as JSON, so that revisions can be compared.
+
+import getopt
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from getitdonelib import TodoDatabase, TodoItem
+
+WORDS = (
+    'update', 'review', 'release', 'fix', 'write', 'document', 'test',
+    'deploy', 'backup', 'migrate', 'clean', 'refactor', 'port', 'merge',
+    'server', 'client', 'database', 'kernel', 'network', 'config', 'build',
+    'periodic', 'daemon', 'socket', 'index', 'cache', 'report', 'budget'
+)
+
+DEFAULTS = {
+    'items': 10000,             # Items in the todo table
+    'tags': 3,                  # Tags per item
+    'vocabulary': 200,          # Distinct tags
+    'spread': 365,              # Deadlines are within that many days
+    'archive': 1000,            # Items deleted before timing
+    'runs': 20,                 # Runs of each timed operation
+    'seed': 0
+}
+
+def makeItem(rnd, params, now):
+    item = TodoItem()
+    item.title.set(' '.join(rnd.sample(WORDS, rnd.randint(2, 6))))
+    item.completion.set(rnd.choice((0, 0, 10, 25, 50, 75, 90, 100)))
+    item.priority.set(rnd.randint(0, 5))
+    if rnd.random() < 0.7:
+        day = rnd.randint(0, params['spread'])
+        item.deadline.set(float(int(now / 86400 + day) * 86400))
+    item.tags.set(['#tag%d' % rnd.randint(1, params['vocabulary'])
+      for i in range(params['tags'])])
+    return item
+
+def generate(dbfile, params):
+    """Fill dbfile with a synthetic database described by params."""
+    rnd = random.Random(params['seed'])
+    now = time.time()
+    todo = TodoDatabase(dbfile)
+    total = params['items'] + params['archive']
+    batch = 10000
+    for first in range(0, total, batch):
+        todo.add_many([makeItem(rnd, params, now)
+          for i in range(first, min(total, first + batch))])
+    if params['archive'] > 0:
+        todo.delete([(1, params['archive'])])
+    return todo
+
+def timeit(fn, runs):
+    times = []
+    for i in range(runs):
+        t0 = time.time()
+        fn(i)
+        times.append(time.time() - t0)
+    times.sort()
+    return {
+        'runs': runs,
+        'min': times[0],
+        'median': times[len(times) / 2],
+        'mean': sum(times) / len(times),
+        'max': times[-1]
+    }
+
+def benchmarks(todo, params):
+    """Return the timed operations, as (name, function of the run index)."""
+    rnd = random.Random(params['seed'] + 1)
+    now = time.time()
+    first = params['archive'] + 1
+    last = params['archive'] + params['items']
+    runs = params['runs']
+    # Every run of delete archives its own slice of the last items.
+    deleted = 10
+    todo.templateadd('bench', "WHERE priority >= ? AND completion < ?")
+
+    def add(i):
+        todo.add(makeItem(rnd, params, now))
+
+    def get_title(i):
+        item = TodoItem()
+        item.title.set(rnd.choice(WORDS))
+        list(todo.iter(item))
+
+    def get_tag(i):
+        item = TodoItem()
+        item.tags.set(['#tag%d' % rnd.randint(1, params['vocabulary'])])
+        list(todo.iter(item))
+
+    def get_deadline(i):
+        item = TodoItem()
+        day = rnd.randint(0, params['spread'])
+        item.deadline.set(float(int(now / 86400 + day) * 86400))
+        list(todo.iter(item))
+
+    def get_id(i):
+        todo.get_id(rnd.randint(first, last - runs * deleted))
+
+    def update(i):
+        item = todo.get_id(rnd.randint(first, last - runs * deleted))
+        item.completion.set(rnd.randint(0, 100))
+        item.tags.add('#tag%d' % rnd.randint(1, params['vocabulary']))
+        todo.update(item)
+
+    def delete(i):
+        end = last - i * deleted
+        todo.delete([(end - deleted + 1, end)])
+
+    def templaterun(i):
+        list(todo.templateiter('bench', (4, 50)))
+
+    def sql(i):
+        # The same items as get_tag: tags are comma-separated.
+        list(todo.iter_raw("WHERE ',' || tags || ',' LIKE ?",
+          ('%%,#tag%d,%%' % rnd.randint(1, params['vocabulary']),)))
+
+    def search(i):
+        todo.search(rnd.sample(WORDS, 2))
+
+    return (
+        ('add', add),
+        ('get_title', get_title),
+        ('get_tag', get_tag),
+        ('get_deadline', get_deadline),
+        ('get_id', get_id),
+        ('update', update),
+        ('delete', delete),
+        ('templaterun', templaterun),
+        ('sql', sql),
+        ('search', search),
+    )
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+          '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+          stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    print "%-14s %10s %10s %7s" % ("operation", "before", "after", "ratio")
+    for name in sorted(results['results']):
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]['median']
+        after = results['results'][name]['median']
+        print "%-14s %9.2fms %9.2fms %6.2fx" % (name, before * 1000,
+          after * 1000, after / before if before > 0 else 0)
+
+def usage(progname):
+    print """
+Usage: %s [-o output.json] [-c previous.json] [param=value ...]
+Params and their default values:
+%s
+The median time of each operation is compared with previous.json when
+given.
+""" % (progname, '\n'.join("  %s=%d" % (k, DEFAULTS[k])
+      for k in sorted(DEFAULTS)))
+
+if __name__ == "__main__":
+    progname = sys.argv[0]
+    output = None
+    previous = None
+    optlist, argv = getopt.gnu_getopt(sys.argv[1:], 'c:ho:')
+    for opt, optarg in optlist:
+        if opt == '-c':
+            previous = json.load(open(optarg, 'r'))
+        elif opt == '-o':
+            output = optarg
+        elif opt == '-h':
+            usage(progname)
+            sys.exit(0)
+
+    params = dict(DEFAULTS)
+    for arg in argv:
+        key, sep, value = arg.partition('=')
+        if key not in params or len(value) == 0:
+            usage(progname)
+            sys.exit(1)
+        params[key] = int(value)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbfile = os.path.join(tmpdir, 'bench.sqlite')
+        t0 = time.time()
+        todo = generate(dbfile, params)
+        results = {
+            'revision': revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'params': params,
+            'generate': time.time() - t0,
+            'size': os.path.getsize(dbfile),
+            'results': {}
+        }
+        for name, fn in benchmarks(todo, params):
+            results['results'][name] = timeit(fn, params['runs'])
+            print >>sys.stderr, "%-14s %9.2fms" % (name,
+              results['results'][name]['median'] * 1000)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if output is not None:
+        f = open(output, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    if previous is not None:
+        compare(results, previous)
@@ -0,0 +1,3302 @@
+#
+# Copyright (c) 2013, Jeremie Le Hen <jeremie@le-hen.org>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met: 
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The todo database and the commands of getitdone.py, which only loads
+# this module for the commands it does not forward to a server.
+
+import base64
+import collections
+import contextlib
+import cStringIO
+import Queue
+import csv
+import glob
+import json
+import itertools
+import os
+import re
+import signal
+import socket
+import struct
+import threading
+import traceback
+import time
+import urllib
+import sqlite3
+import sys
+
+from getitdone import DB_FILE, SOCKET_SUFFIX
+
+KNOWN_DATE_FORMATS = (
+    '%y/%m/%d', '%Y/%m/%d', '%d/%m/%Y',
+    '%y-%m-%d', '%Y-%m-%d', '%d-%m-%Y',
+    '%y%m%d', '%Y%m%d'
+)
+# Seconds to wait for other writers before giving up with "database is
+# locked".
+BUSY_TIMEOUT = 30.0
+# Commands for which the database is opened read-only.
+READONLY_COMMANDS = ('get', 'print', 'list', 'search', 'sql', 'explain',
+  'tags', 'stats', 'history', 'export')
+# Running a template may refresh its materialization.
+READONLY_TEMPLATE_COMMANDS = ('show', 'materialized')
+# Commands which run against several databases at once, each in its own
+# thread: sqlite releases the GIL while it executes a statement.
+MULTI_COMMANDS = ('get', 'print', 'list', 'sql', 'template', 'tmpl',
+  'stats')
+# Files matched by a -d glob which are not databases themselves.
+MULTI_EXCLUDES = (SOCKET_SUFFIX, '-wal', '-shm', '-journal')
+# Pager settings applied to each connection, see parseIoProfile().  Large
+# listings, especially from network file systems, are read faster with
+# memory-mapped I/O and a bigger page cache; temp_store keeps sorts and
+# temporary tables in memory.
+IO_PROFILES = {
+    'default': {},
+    'fast': {
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,               # In KiB when negative
+        'temp_store': 'MEMORY'
+    },
+    'small': {
+        'mmap_size': 0,
+        'cache_size': -512,
+        'temp_store': 'FILE'
+    }
+}
+IO_PRAGMAS = ('mmap_size', 'cache_size', 'temp_store')
+IO_ENVIRON = "GETITDONE_IO"
+
+class DateParser(object):
+    """Parse dates into timestamps, for one stream of input.
+
+    Absolute dates are tried against the format of the previous date
+    first, then against KNOWN_DATE_FORMATS in order, and remembered.
+    Relative dates are today, tomorrow, yesterday and [+-]n followed by
+    d, w, m or y, counted from the beginning of today.
+    """
+
+    RELATIVE_DATE = re.compile(r'^([+-]?)(\d+)([dwmy])$')
+    NAMED_DATES = {'today': 0, 'tomorrow': 1, 'yesterday': -1}
+    # Remembered dates, beyond which the cache starts over.
+    CACHE_SIZE = 4096
+
+    def __init__(self, formats=KNOWN_DATE_FORMATS):
+        self._formats = formats
+        self._format = None
+        self._cache = {}
+
+    def parse(self, arg):
+        date = self._cache.get(arg)
+        if date is not None:
+            return date
+        date = self._relative(arg)
+        if date is not None:
+            # Not cached: today changes.
+            return date
+        date = self._absolute(arg)
+        if len(self._cache) >= DateParser.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[arg] = date
+        return date
+
+    def _absolute(self, arg):
+        formats = self._formats
+        if self._format is not None:
+            formats = (self._format,) + formats
+        for fmt in formats:
+            try:
+                date = time.mktime(time.strptime(arg, fmt))
+            except ValueError:
+                continue
+            self._format = fmt
+            return date
+        raise ValueError("Unknown date format: %s" % arg)
+
+    @staticmethod
+    def _relative(arg):
+        if arg in DateParser.NAMED_DATES:
+            sign, n, unit = '+', DateParser.NAMED_DATES[arg], 'd'
+        else:
+            match = DateParser.RELATIVE_DATE.match(arg)
+            if match is None:
+                return None
+            sign, n, unit = match.group(1), int(match.group(2)), \
+              match.group(3)
+        if sign == '-':
+            n = -n
+        year, month, day = time.localtime()[0:3]
+        if unit == 'd':
+            day += n
+        elif unit == 'w':
+            day += 7 * n
+        elif unit == 'm':
+            month += n
+        else:
+            year += n
+        # mktime() normalizes out of range days and months.
+        return time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+
+_dateParser = DateParser()
+
+def parseDate(arg, dates=None):
+    """Parse arg with dates, a DateParser, or with a shared one."""
+    return (dates or _dateParser).parse(arg)
+
+def parseProperties(argv, dates=None):
+    item = TodoItem()
+    title = []
+    tags = set()
+    untags = set()
+    for arg in argv:
+        if arg[0] == '#':                               # Add tag
+            tags.add(arg)
+        elif arg[0:2] == "-#":                          # Remove tag
+            untags.add(arg[1:])
+        elif arg[0] == '%':                             # Set completion
+            item.completion.set(int(arg[1:]))
+        elif arg[0:2] == '-%':                          # Unset completion
+            item.completion.unset()
+        elif arg[0] == '!':                             # Set priority
+            item.priority.set(int(arg[1:]))
+        elif arg[0:2] == '-!':                          # Unset priority
+            item.priority.unset()
+        elif arg[0] == '@':                             # Set deadline
+            item.deadline.set(parseDate(arg[1:], dates))
+        elif arg[0:2] == '-@':                          # Set deadline
+            item.deadline.unset()
+        else:
+            title.append(arg)
+    return item, title, tags, untags
+
+def parseIoProfile(spec):
+    """Return the pragmas described by spec, as taken by TodoDatabase.
+
+    spec is a comma-separated list of IO_PROFILES names and of
+    pragma=value settings, later ones taking precedence, e.g.
+    "fast,cache_size=-200000".
+    """
+    pragmas = {}
+    for word in spec.split(','):
+        name, sep, value = word.strip().partition('=')
+        if len(sep) == 0:
+            if name not in IO_PROFILES:
+                raise ValueError("Unknown I/O profile: %s" % name)
+            pragmas.update(IO_PROFILES[name])
+        elif name in IO_PRAGMAS:
+            pragmas[name] = value
+        else:
+            raise ValueError("Unknown I/O setting: %s" % name)
+    return pragmas
+
+def parsePaging(words):
+    """Split sort=, limit=, offset= and after= words from the others.
+
+    Returns the other words and the matching keyword arguments of
+    TodoDatabase.get().
+    """
+    paging = {}
+    rest = []
+    for word in words:
+        key, sep, value = word.partition('=')
+        if key == 'sort' and len(value) > 0:
+            paging['order'] = value
+        elif key in ('limit', 'offset') and value.isdigit():
+            paging[key] = int(value)
+        elif key == 'after' and len(value) > 0:
+            paging['after'] = value
+        else:
+            rest.append(word)
+    return rest, paging
+
+def parseIds(words):
+    """Split rowids and first-last ranges from the other words.
+
+    Returns the ids, as taken by TodoDatabase.delete(), and the others.
+    """
+    ids = []
+    rest = []
+    for word in words:
+        bounds = word.split('-')
+        if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit():
+            ids.append((int(bounds[0]), int(bounds[1])))
+        elif word.isdigit():
+            ids.append(int(word))
+        else:
+            rest.append(word)
+    return ids, rest
+
+def parseImportLine(line, dates=None):
+    """Build a new TodoItem from an import line.
+
+    The line is either a JSON object with the keys title, description,
+    deadline, completion, priority and tags, or the same property syntax
+    as the add command.  Dates are parsed with dates, a DateParser,
+    which should be the same for all the lines of a file.
+    """
+    if line.lstrip()[0:1] == '{':
+        d = json.loads(line)
+        item = TodoItem()
+        if not d.get('title'):
+            raise ValueError("Empty title")
+        item.title.set(d['title'])
+        if d.get('description') is not None:
+            item.description.set(d['description'])
+        if d.get('completion') is not None:
+            item.completion.set(int(d['completion']))
+        if d.get('priority') is not None:
+            item.priority.set(int(d['priority']))
+        deadline = d.get('deadline')
+        if isinstance(deadline, basestring):
+            deadline = parseDate(deadline, dates)
+        if deadline is not None:
+            item.deadline.set(deadline)
+        item.tags.set(map(lambda t: t if t[0:1] == '#' else '#' + t,
+          d.get('tags') or []))
+        return item
+
+    item, title, tags, untags = parseProperties(line.split(), dates)
+    if len(title) == 0:
+        raise ValueError("Empty title")
+    item.title.set(' '.join(title))
+    item.tags.set(tags)
+    return item
+
+def printTodoItem(record):
+    TodoRenderer(sys.stdout).writeall((record,))
+
+class TodoRenderer(object):
+    """Format records in batches and write them out in large chunks.
+
+    Formats are 'table', the listing of printTodoItem(), 'json', one
+    object per line, and 'tsv' and 'csv', with a header line.  The last
+    three keep every column as stored, e.g. deadline as a timestamp.  In
+    tsv, backslashes, tabs and line breaks are escaped C-style, and NULL
+    is written as \\N.  With sources, every record is written along with
+    the database it comes from: a prefix of the table line, a 'db' key in
+    json and a first 'db' column in tsv and csv.
+    """
+
+    FORMATS = ('table', 'json', 'tsv', 'csv')
+    COLUMNS = ('rowid', 'creation', 'lastupdate', 'updates', 'deadline',
+      'title', 'description', 'completion', 'priority', 'tags')
+    # Records formatted before each write.
+    BATCH = 512
+    # Formatted deadlines are cached by quarter of an hour, the unit of
+    # time zone offsets, so a local day is a few entries whatever the
+    # time of deadlines.  Beyond that many entries, the cache starts over.
+    DATE_QUANTUM = 900
+    DATE_CACHE_SIZE = 4096
+    TSV_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+      ('\r', '\\r'))
+    TSV_SPECIAL = re.compile(r'[\\\t\n\r]')
+
+    def __init__(self, out, fmt='table', sources=False):
+        if fmt not in TodoRenderer.FORMATS:
+            raise ValueError("Unknown format: %s" % fmt)
+        self._out = out
+        self._fmt = fmt
+        self._format = getattr(self, '_' + fmt)
+        self._sources = sources
+        self._buf = cStringIO.StringIO()
+        self._count = 0
+        self._dates = {}
+        self._csvwriter = None
+        columns = TodoRenderer.COLUMNS
+        if sources:
+            columns = ('db',) + columns
+        if fmt == 'csv':
+            self._csvwriter = csv.writer(self._buf, lineterminator='\n')
+            self._csvwriter.writerow(columns)
+        elif fmt == 'tsv':
+            self._buf.write('\t'.join(columns) + '\n')
+
+    def write(self, record, source=None):
+        self._format(record, source)
+        self._count += 1
+        if self._count >= TodoRenderer.BATCH:
+            self.flush()
+
+    def writeall(self, records):
+        """Write all records and flush; return their count."""
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+        self.flush()
+        return count
+
+    def flush(self):
+        self._out.write(self._buf.getvalue())
+        self._out.flush()
+        self._buf = cStringIO.StringIO()
+        if self._csvwriter is not None:
+            self._csvwriter = csv.writer(self._buf, lineterminator='\n')
+        self._count = 0
+
+    def _date(self, timestamp):
+        key = int(timestamp // TodoRenderer.DATE_QUANTUM)
+        date = self._dates.get(key)
+        if date is None:
+            if len(self._dates) >= TodoRenderer.DATE_CACHE_SIZE:
+                self._dates.clear()
+            date = time.strftime('@%y/%m/%d', time.localtime(timestamp))
+            self._dates[key] = date
+        return date
+
+    def _table(self, record, source):
+        if self._sources:
+            self._buf.write(source + ': ')
+        line = u"[%3s] %3s %-4s %-9s %s %s\n" % (
+          " - " if record.rowid is None else "%3d" % record.rowid,
+          "" if record.priority is None else "%2d!" % record.priority,
+          "" if record.completion is None else "%3d%%" % record.completion,
+          "" if record.deadline is None else self._date(record.deadline),
+          record.tagstring or "", record.title)
+        self._buf.write(line.encode('utf-8'))
+
+    def _json(self, record, source):
+        row = dict(zip(TodoRenderer.COLUMNS, record))
+        row['tags'] = list(record.tags)
+        if self._sources:
+            row['db'] = source
+        self._buf.write(json.dumps(row) + '\n')
+
+    def _tsv(self, record, source):
+        fields = []
+        if self._sources:
+            record = (source,) + tuple(record)
+        for value in record:
+            if value is None:
+                fields.append('\\N')
+                continue
+            if isinstance(value, basestring):
+                if TodoRenderer.TSV_SPECIAL.search(value) is None:
+                    fields.append(value)
+                    continue
+                for char, escape in TodoRenderer.TSV_ESCAPES:
+                    value = value.replace(char, escape)
+            elif isinstance(value, float):
+                value = repr(value)
+            else:
+                value = str(value)
+            fields.append(value)
+        self._buf.write(u'\t'.join(fields).encode('utf-8') + '\n')
+
+    def _csv(self, record, source):
+        if self._sources:
+            record = (source,) + tuple(record)
+        self._csvwriter.writerow([value.encode('utf-8')
+          if isinstance(value, unicode) else value for value in record])
+
+
+class TodoItem(object):
+
+    class ROProperty(object):
+
+        def __init__(self, value=None):
+            self._value = value
+
+        def get(self):
+            return self._value
+
+    class RWProperty(ROProperty):
+
+        def __init__(self, value=None):
+            super(TodoItem.RWProperty, self).__init__(value)
+            self.modified = False
+
+        def set(self, value):
+            self._value = value
+            self.modified = True
+
+        def isModified(self):
+            return self.modified
+
+
+    class RWDProperty(RWProperty):
+
+        def unset(self):
+            self._value = None
+            self.modified = True
+
+
+    class RWSet(object):
+
+        def __init__(self, values=[]):
+            self._oset = set(values)
+            self._set = set(values)
+            self._modified = False
+
+        def __iter__(self):
+            return iter(self._set)
+
+        def len(self):
+            return len(self._set)
+
+        def get(self):
+            return self._set.copy()
+
+        def set(self, values):
+            self._set = set(values)
+            self._modified = True
+
+        def add(self, values):
+            if isinstance(values, set) or isinstance(values, frozenset) or \
+              isinstance(values, tuple) or isinstance(values, list):
+                self._set.update(values)
+            else:
+                self._set.add(values)
+            self._modified = True
+
+        def delete(self, values):
+            if isinstance(values, set) or isinstance(values, frozenset) or \
+              isinstance(values, tuple) or isinstance(values, list):
+                self._set.difference_update(values)
+            else:
+                self._set.discard(values)
+            self._modified = True
+
+        def isModified(self):
+            return self._modified
+
+        def difference(self):
+            if not self._modified:
+                return ((), ())
+            plus = self._set - self._oset
+            minus = self._oset - self._set
+            return (plus, minus)
+
+
+    def __init__(self, rowid=None, creation=None, lastupdate=None, updates=None):
+        self.rowid = TodoItem.ROProperty(rowid)
+        self.creation = TodoItem.ROProperty(creation)
+        self.lastupdate = TodoItem.ROProperty(lastupdate)
+        self.updates = TodoItem.ROProperty(updates)
+
+        self.title = TodoItem.RWProperty()
+        self.deadline = TodoItem.RWDProperty()
+        self.completion = TodoItem.RWDProperty()
+        self.priority = TodoItem.RWDProperty()
+        self.description = TodoItem.RWProperty()
+
+        self.tags = TodoItem.RWSet()
+
+    @classmethod
+    def fromRow(cls, row):
+        item = cls(row['rowid'], row['creation'], row['lastupdate'],
+          row['updates'])
+        item.title = TodoItem.RWProperty(row['title'])
+        item.deadline = TodoItem.RWDProperty(row['deadline'])
+        item.completion = TodoItem.RWDProperty(row['completion'])
+        item.priority = TodoItem.RWDProperty(row['priority'])
+        item.description = TodoItem.RWDProperty(row['description'])
+        tags = row['tags'] if row['tags'] is not None else ''
+        item.tags = TodoItem.RWSet(tags.split(','))
+        return item
+
+    @property
+    def modified(self):
+        return self.title.isModified() or self.deadline.isModified() or \
+          self.completion.isModified() or self.priority.isModified() or \
+          self.description.isModified() or self.tags.isModified()
+
+    def update(self, modification):
+        if modification.title.isModified():
+            self.title.set(modification.title.get())
+        if modification.deadline.isModified():
+            self.deadline.set(modification.deadline.get())
+        if modification.completion.isModified():
+            self.completion.set(modification.completion.get())
+        if modification.priority.isModified():
+            self.priority.set(modification.priority.get())
+        if modification.description.isModified():
+            self.description.set(modification.description.get())
+        if modification.tags.isModified():
+            self.tags.set(modification.tags.get())
+
+
+def explainQuery(conn, query, params=()):
+    """Return the EXPLAIN QUERY PLAN of query as indented lines."""
+    c = sqlite3.Connection.cursor(conn)
+    c.execute("EXPLAIN QUERY PLAN " + query, params)
+    depth = {0: -1}
+    lines = []
+    for row in c.fetchall():
+        # Since SQLite 3.24, rows are (id, parent, notused, detail).
+        depth[row[0]] = depth.get(row[1], -1) + 1
+        lines.append("  " * depth[row[0]] + row[-1])
+    return lines
+
+def printTrace(query, params, seconds, rows, plan):
+    """Trace hook writing each statement to stderr."""
+    print >>sys.stderr, "-- %.3fms, %d row(s): %s %r" % (seconds * 1000,
+      rows, ' '.join(query.split()), params)
+    for line in plan or ():
+        print >>sys.stderr, "--   " + line
+
+
+class TodoConnection(sqlite3.Connection):
+    """Connection handing out TracingCursors while a trace hook is set."""
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.tracehook = None
+        self.traceplans = False
+
+    def cursor(self, factory=sqlite3.Cursor):
+        if self.tracehook is not None:
+            factory = TracingCursor
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Cursor calling the connection trace hook for each statement.
+
+    The hook gets the statement, its parameters, the time spent executing
+    it and fetching its rows, the number of rows returned (or changed) and
+    its query plan if asked for.  It is called once the rows are all
+    fetched, or when the cursor is reused or closed.
+    """
+
+    EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+    def __init__(self, conn):
+        sqlite3.Cursor.__init__(self, conn)
+        self._trace = None
+
+    def _report(self):
+        if self._trace is not None:
+            trace, self._trace = self._trace, None
+            self.connection.tracehook(*trace)
+
+    def execute(self, query, params=()):
+        self._report()
+        plan = None
+        if self.connection.traceplans and \
+          query.split(None, 1)[0].upper() in TracingCursor.EXPLAINED:
+            plan = explainQuery(self.connection, query, params)
+        t0 = time.time()
+        sqlite3.Cursor.execute(self, query, params)
+        self._trace = [query, params, time.time() - t0, 0, plan]
+        if self.description is None:
+            self._trace[3] = max(self.rowcount, 0)
+            self._report()
+        return self
+
+    def executemany(self, query, seq):
+        self._report()
+        t0 = time.time()
+        sqlite3.Cursor.executemany(self, query, seq)
+        self._trace = [query, (), time.time() - t0, max(self.rowcount, 0),
+          None]
+        self._report()
+        return self
+
+    def _fetched(self, t0, count, done):
+        if self._trace is not None:
+            self._trace[2] += time.time() - t0
+            self._trace[3] += count
+            if done:
+                self._report()
+
+    def fetchone(self):
+        t0 = time.time()
+        row = sqlite3.Cursor.fetchone(self)
+        self._fetched(t0, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        t0 = time.time()
+        rows = sqlite3.Cursor.fetchmany(self, size or self.arraysize)
+        self._fetched(t0, len(rows), len(rows) == 0)
+        return rows
+
+    def fetchall(self):
+        t0 = time.time()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._fetched(t0, len(rows), True)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._report()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        self._report()
+
+
+class TodoRecord(collections.namedtuple('TodoRecord', (
+  'rowid', 'creation', 'lastupdate', 'updates', 'deadline', 'title',
+  'description', 'completion', 'priority', 'tagstring'))):
+    """Read-only item, as returned by queries.
+
+    Unlike TodoItem, it does not track changes; it is a plain tuple of
+    the columns of SQL_JOIN_QUERY.  Use TodoDatabase.get_id() to get an
+    updatable TodoItem.
+    """
+
+    __slots__ = ()
+
+    @property
+    def tags(self):
+        if self.tagstring is None:
+            return ()
+        return tuple(self.tagstring.split(','))
+
+
+class TodoDatabase:
+
+    # Number of rows fetched at once when iterating over results.
+    FETCH_SIZE = 256
+
+    # Full-text index pages merged by automatic maintain() runs, which
+    # happen within writes and must not rewrite the whole index.
+    FTS_MERGE_PAGES = 64
+
+    # Completion ranges counted by stats(), inclusive.
+    COMPLETION_BUCKETS = ((0, 0), (1, 24), (25, 49), (50, 74), (75, 99),
+      (100, 100))
+
+    SQL_TODO_TABLE = """
+    CREATE TABLE IF NOT EXISTS todo (
+        creation INTEGER DEFAULT CURRENT_TIMESTAMP,
+        lastupdate INTEGER DEFAULT CURRENT_TIMESTAMP,
+        updates INTEGER DEFAULT 0,
+        deadline INTEGER,
+        title TEXT NOT NULL ON CONFLICT ABORT,
+        description TEXT,
+        completion INTEGER DEFAULT 0
+            CHECK (completion >= 0 AND completion <= 100),
+        priority INTEGER DEFAULT 0
+    );
+    """
+
+    # The expressions match SORT_KEYS, so that ordered listings are read
+    # in index order and stop after the requested number of items.
+    SQL_TODO_TABLE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS index_deadline ON todo (deadline);
+
+    CREATE INDEX IF NOT EXISTS index_lastupdate ON todo (lastupdate);
+
+    CREATE INDEX IF NOT EXISTS index_due ON todo (ifnull(deadline, 9e999));
+
+    CREATE INDEX IF NOT EXISTS index_priority ON todo (ifnull(priority, 0));
+
+    CREATE INDEX IF NOT EXISTS index_progress
+    ON todo (ifnull(completion, 0));
+
+    CREATE INDEX IF NOT EXISTS index_completion_due
+    ON todo (completion, ifnull(deadline, 9e999));
+
+    CREATE INDEX IF NOT EXISTS index_completion_priority
+    ON todo (completion, ifnull(priority, 0));
+    """
+
+    # Statements maintaining updates and lastupdate themselves, as
+    # TodoDatabase does once per item and operation, including for tag
+    # changes, bypass the trigger.  So do those which change nothing.
+    SQL_TODO_TABLE_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trigger_update_todo
+    AFTER UPDATE OF deadline, title, description, completion, priority ON todo
+    WHEN NEW.updates IS OLD.updates AND (
+        NEW.deadline IS NOT OLD.deadline OR
+        NEW.title IS NOT OLD.title OR
+        NEW.description IS NOT OLD.description OR
+        NEW.completion IS NOT OLD.completion OR
+        NEW.priority IS NOT OLD.priority
+    )
+    BEGIN
+        UPDATE todo
+        SET updates = updates + 1, lastupdate = CURRENT_TIMESTAMP
+        WHERE rowid = NEW.rowid;
+    END;
+    """
+
+    # archivekey is never reused, even once compact() emptied the table,
+    # as other copies of the database know archived items by it.
+    SQL_ARCHIVE_TABLE = """
+    CREATE TABLE IF NOT EXISTS archive (
+        archivekey INTEGER PRIMARY KEY AUTOINCREMENT,
+        creation INTEGER DEFAULT CURRENT_TIMESTAMP,
+        lastupdate INTEGER DEFAULT CURRENT_TIMESTAMP,
+        updates INTEGER DEFAULT 0,
+        deadline INTEGER,
+        title TEXT NOT NULL ON CONFLICT ABORT,
+        description TEXT,
+        completion INTEGER DEFAULT 0
+            CHECK (completion >= 0 AND completion <= 100),
+        priority INTEGER DEFAULT 0,
+        archivetime INTEGER DEFAULT CURRENT_TIMESTAMP,
+        tags TEXT
+    );
+    """
+
+    # Each tag name is stored once in tagnames, along with the number of
+    # items it is attached to; tags only holds integer pairs.
+    # Archived items can be moved out of the database, into one file per
+    # month or year of archivetime named after the database file.
+    PARTITION_SUFFIX = ".archive-%s"
+    PARTITION_PERIODS = {
+        'month': '%Y-%m',
+        'year': '%Y'
+    }
+
+    SQL_TAGNAMES_TABLE = """
+    CREATE TABLE IF NOT EXISTS tagnames (
+        tagkey INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        uses INTEGER NOT NULL DEFAULT 0
+    );
+    """
+
+    SQL_TAGS_TABLE = """
+    CREATE TABLE IF NOT EXISTS tags (
+        todokey INTEGER REFERENCES todo (rowid) ON DELETE CASCADE,
+        tagkey INTEGER REFERENCES tagnames (tagkey),
+        PRIMARY KEY (todokey, tagkey)
+    ) WITHOUT ROWID;
+    """
+
+    SQL_TAGS_TABLE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS index_tagkey_todokey ON tags (tagkey, todokey);
+    """
+
+    # Names no longer used by any item are dropped from the dictionary.
+    SQL_TAGS_TABLE_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trigger_insert_tags AFTER INSERT ON tags
+    BEGIN
+        UPDATE tagnames SET uses = uses + 1 WHERE tagkey = NEW.tagkey;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_delete_tags AFTER DELETE ON tags
+    BEGIN
+        UPDATE tagnames SET uses = uses - 1 WHERE tagkey = OLD.tagkey;
+        DELETE FROM tagnames WHERE tagkey = OLD.tagkey AND uses <= 0;
+    END;
+    """
+
+    # Latest change of each todo item, item tag and archived item, so that
+    # other copies of the database can catch up from a given seq.  An
+    # entry is replaced, with a new seq, on each change of its key; the
+    # rows themselves are read at export time.  Archived items leaving
+    # the database for a partition are not logged.
+    SQL_CHANGELOG_TABLE = """
+    CREATE TABLE IF NOT EXISTS changelog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        key INTEGER NOT NULL,
+        name TEXT NOT NULL DEFAULT '',
+        deleted INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS index_changelog_key
+    ON changelog (tbl, key, name);
+    """
+
+    # Not INSERT OR REPLACE, as the conflict clause of the statement
+    # firing the trigger, e.g. INSERT OR IGNORE, would take precedence.
+    # Every change of a todo row ends with a bump of updates, either by
+    # TodoDatabase or by trigger_update_todo.  The name of a removed tag
+    # is read before trigger_delete_tags may drop it.
+    SQL_CHANGELOG_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trigger_log_insert_todo AFTER INSERT ON todo
+    BEGIN
+        DELETE FROM changelog WHERE tbl = 'todo' AND key = NEW.rowid;
+        INSERT INTO changelog (tbl, key) VALUES ('todo', NEW.rowid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_log_update_todo AFTER UPDATE ON todo
+    WHEN NEW.updates IS NOT OLD.updates
+    BEGIN
+        DELETE FROM changelog WHERE tbl = 'todo' AND key = NEW.rowid;
+        INSERT INTO changelog (tbl, key) VALUES ('todo', NEW.rowid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_log_delete_todo AFTER DELETE ON todo
+    BEGIN
+        DELETE FROM changelog WHERE tbl = 'todo' AND key = OLD.rowid;
+        INSERT INTO changelog (tbl, key, deleted)
+        VALUES ('todo', OLD.rowid, 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_log_insert_tags AFTER INSERT ON tags
+    BEGIN
+        DELETE FROM changelog
+        WHERE tbl = 'tags' AND key = NEW.todokey AND name = (
+            SELECT name FROM tagnames WHERE tagkey = NEW.tagkey
+        );
+        INSERT INTO changelog (tbl, key, name)
+        SELECT 'tags', NEW.todokey, name
+        FROM tagnames WHERE tagkey = NEW.tagkey;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_log_delete_tags BEFORE DELETE ON tags
+    BEGIN
+        DELETE FROM changelog
+        WHERE tbl = 'tags' AND key = OLD.todokey AND name = (
+            SELECT name FROM tagnames WHERE tagkey = OLD.tagkey
+        );
+        INSERT INTO changelog (tbl, key, name, deleted)
+        SELECT 'tags', OLD.todokey, name, 1
+        FROM tagnames WHERE tagkey = OLD.tagkey;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_log_insert_archive
+    AFTER INSERT ON archive
+    BEGIN
+        DELETE FROM changelog
+        WHERE tbl = 'archive' AND key = NEW.archivekey;
+        INSERT INTO changelog (tbl, key) VALUES ('archive', NEW.archivekey);
+    END;
+    """
+
+    SQL_SETTINGS_TABLE = """
+    CREATE TABLE IF NOT EXISTS settings (
+        name TEXT NOT NULL PRIMARY KEY,
+        value
+    );
+    """
+
+    # Columns of todo and archive carried by export() and apply().
+    CHANGELOG_COLUMNS = ('creation', 'lastupdate', 'updates', 'deadline',
+      'title', 'description', 'completion', 'priority')
+
+    SQL_TEMPLATES_TABLE = """
+    CREATE TABLE IF NOT EXISTS templates (
+        name TEXT NOT NULL PRIMARY KEY,
+        query TEXT NOT NULL
+    );
+    """
+
+    # Templates can be materialized for a given list of parameters: the
+    # rowids of the matching items are kept in materialized, and only the
+    # items updated since the last refresh are checked again.
+    SQL_MATERIALIZED_TABLES = """
+    CREATE TABLE IF NOT EXISTS materializations (
+        matkey INTEGER PRIMARY KEY,
+        name TEXT NOT NULL REFERENCES templates (name),
+        params TEXT NOT NULL,
+        refreshed TEXT,
+        UNIQUE (name, params)
+    );
+
+    CREATE TABLE IF NOT EXISTS materialized (
+        matkey INTEGER REFERENCES materializations (matkey),
+        todokey INTEGER REFERENCES todo (rowid),
+        PRIMARY KEY (matkey, todokey)
+    );
+    """
+
+    # Full-text index over todo.title and todo.description, using the
+    # todo table as external content.  FTS5 is preferred, FTS4 is used
+    # when the SQLite library lacks it.
+    SQL_FTS5_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS todo_fts
+    USING fts5 (title, description, content = 'todo');
+    """
+
+    SQL_FTS5_TABLE_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trigger_insert_todo_fts AFTER INSERT ON todo
+    BEGIN
+        INSERT INTO todo_fts (rowid, title, description)
+        VALUES (NEW.rowid, NEW.title, NEW.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_delete_todo_fts AFTER DELETE ON todo
+    BEGIN
+        INSERT INTO todo_fts (todo_fts, rowid, title, description)
+        VALUES ('delete', OLD.rowid, OLD.title, OLD.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_update_todo_fts
+    AFTER UPDATE OF title, description ON todo
+    BEGIN
+        INSERT INTO todo_fts (todo_fts, rowid, title, description)
+        VALUES ('delete', OLD.rowid, OLD.title, OLD.description);
+
+        INSERT INTO todo_fts (rowid, title, description)
+        VALUES (NEW.rowid, NEW.title, NEW.description);
+    END;
+    """
+
+    SQL_FTS4_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS todo_fts
+    USING fts4 (content='todo', title, description);
+    """
+
+    # FTS4 reads the old content back from todo when deleting, hence the
+    # BEFORE triggers.
+    SQL_FTS4_TABLE_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trigger_insert_todo_fts AFTER INSERT ON todo
+    BEGIN
+        INSERT INTO todo_fts (docid, title, description)
+        VALUES (NEW.rowid, NEW.title, NEW.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_delete_todo_fts BEFORE DELETE ON todo
+    BEGIN
+        DELETE FROM todo_fts WHERE docid = OLD.rowid;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_preupdate_todo_fts
+    BEFORE UPDATE OF title, description ON todo
+    BEGIN
+        DELETE FROM todo_fts WHERE docid = OLD.rowid;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trigger_update_todo_fts
+    AFTER UPDATE OF title, description ON todo
+    BEGIN
+        INSERT INTO todo_fts (docid, title, description)
+        VALUES (NEW.rowid, NEW.title, NEW.description);
+    END;
+    """
+
+    # Same rows as SQL_JOIN_QUERY, but conditions on todo go in {where}
+    # and ordering in {tail}, so that they are applied before tags are
+    # aggregated, and only for the items returned.
+    SQL_ITEM_QUERY = """
+    SELECT
+        todo.rowid AS rowid,
+        todo.creation AS creation,
+        todo.lastupdate AS lastupdate,
+        todo.updates AS updates,
+        todo.deadline AS deadline,
+        todo.title AS title,
+        todo.description AS description,
+        todo.completion AS completion,
+        todo.priority AS priority,
+        (SELECT group_concat(tagnames.name, ",")
+         FROM tags JOIN tagnames ON tagnames.tagkey = tags.tagkey
+         WHERE tags.todokey = todo.rowid) AS tags
+    FROM todo
+    {where}
+    {tail}
+    """
+
+    # Expressions by which get() can order items, without NULLs so that
+    # keyset paging can compare them; an item without deadline is due
+    # last.
+    SORT_KEYS = {
+        'deadline': "ifnull(todo.deadline, 9e999)",
+        'priority': "ifnull(todo.priority, 0)",
+        'completion': "ifnull(todo.completion, 0)",
+        'lastupdate': "todo.lastupdate"
+    }
+
+    SQL_JOIN_QUERY = """
+    SELECT *
+    FROM (
+        SELECT
+            todo.rowid,
+            todo.creation,
+            todo.lastupdate,
+            todo.updates,
+            todo.deadline,
+            todo.title,
+            todo.description,
+            todo.completion,
+            todo.priority,
+            group_concat(tagnames.name, ",") AS tags
+        FROM
+            todo LEFT OUTER JOIN tags ON todo.rowid = tags.todokey
+            LEFT OUTER JOIN tagnames ON tags.tagkey = tagnames.tagkey
+        GROUP BY todo.rowid
+        )
+    """
+
+    # Methods upgrading the schema of an existing database from version
+    # i to version i + 1, as stored in PRAGMA user_version.  New
+    # databases are created directly at SCHEMA_VERSION.
+    SCHEMA_MIGRATIONS = (
+        '_migrate1',                    # Unversioned: add full-text index
+        '_migrate2',                    # Materialized templates
+        '_migrate3',                    # WAL journal
+        '_migrate4',                    # One bump per item update
+        '_migrate5',                    # Indexes for ordered listings
+        '_migrate6',                    # Tag dictionary
+        '_migrate7',                    # Change log
+        '_migrate8',                    # Settings
+        '_migrate9',                    # No bump for unchanged items
+        '_migrate10',                   # Archive keys never reused
+    )
+    SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+    # Whether the SQLite library accepts file: URIs, when known.
+    _uri = None
+
+    def __init__(self, dbfile, readonly=False, timeout=BUSY_TIMEOUT,
+      shared=False, pragmas={}):
+        """Open dbfile, creating or upgrading it if needed.
+
+        A readonly database is opened in read-only mode when possible.
+        A shared instance may be used from several threads, provided they
+        do not use it at the same time.  pragmas are pager settings, see
+        parseIoProfile().
+        """
+        self._dbfile = dbfile
+        self._timeout = timeout
+        self._shared = shared
+        self._txdepth = 0
+        self._fts = None
+        self._stats = None
+        self._maintainevery = 0
+        self._conn = None
+        if readonly:
+            self._conn = self._connectro()
+        if self._conn is None:
+            self._conn = self._connect(dbfile)
+            self._upgrade()
+        # Durable enough with WAL: a power loss may only lose the last
+        # transactions, not corrupt the database.
+        self._conn.execute("PRAGMA synchronous = NORMAL;")
+        for name in sorted(pragmas):
+            TodoDatabase._pragma(self._conn, name, pragmas[name])
+        if readonly:
+            self._conn.execute("PRAGMA query_only = ON;")
+        else:
+            self._maintainevery = self._setting('maintain_every', 0)
+
+    def _connect(self, path):
+        # SQLite's busy handler retries with an increasing delay until
+        # timeout expires.
+        conn = sqlite3.connect(path, self._timeout, factory=TodoConnection,
+          check_same_thread=not self._shared)
+        conn.row_factory = sqlite3.Row
+        conn.isolation_level = None
+        return conn
+
+    def _connectro(self):
+        # Python 2 cannot ask for URIs, they only work if the library was
+        # built with them on; otherwise the URI would be a file name.
+        if TodoDatabase._uri is None:
+            TodoDatabase._uri = sqlite3.connect(':memory:').execute("""
+            SELECT sqlite_compileoption_used('SQLITE_USE_URI');
+            """).fetchone()[0] == 1
+        if not TodoDatabase._uri:
+            return None
+        try:
+            conn = self._connect("file:%s?mode=ro" % \
+              urllib.quote(os.path.abspath(self._dbfile)))
+            c = conn.cursor()
+            if self._schemaversion(c) == TodoDatabase.SCHEMA_VERSION:
+                return conn
+        except sqlite3.OperationalError:
+            # Missing file, or WAL files this process cannot create.
+            return None
+        # To be created or upgraded first.
+        conn.close()
+        return None
+
+    @staticmethod
+    def _pragma(conn, name, value):
+        if name not in IO_PRAGMAS:
+            raise ValueError("Unknown I/O setting: %s" % name)
+        value = str(value).upper()
+        if not re.match(r'^(-?\d+|DEFAULT|FILE|MEMORY)$', value):
+            raise ValueError("Invalid value for %s: %s" % (name, value))
+        c = conn.execute("PRAGMA %s = %s;" % (name, value))
+        # mmap_size returns the new value.
+        c.fetchall()
+
+    def close(self):
+        self._conn.close()
+
+    def _schemaversion(self, c):
+        c.execute("PRAGMA user_version;")
+        version = c.fetchone()[0]
+        if version > TodoDatabase.SCHEMA_VERSION:
+            raise ValueError("Unsupported database schema version: %d" % \
+              version)
+        return version
+
+    def _upgrade(self):
+        c = self._conn.cursor()
+        if self._schemaversion(c) == TodoDatabase.SCHEMA_VERSION:
+            return
+        c.execute("SELECT count(*) FROM sqlite_master;")
+        if c.fetchone()[0] == 0:
+            # Only possible before the first table is created, and not
+            # inside a transaction.  A full VACUUM would enable it later,
+            # but it may renumber the items, which have no INTEGER
+            # PRIMARY KEY.
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        with self.transaction() as c:
+            # Check again, someone else may have been quicker.
+            version = self._schemaversion(c)
+            c.execute("""
+            SELECT count(*) FROM sqlite_master WHERE type = 'table';
+            """)
+            if version == 0 and c.fetchone()[0] == 0:
+                self._create(c)
+            else:
+                for migration in TodoDatabase.SCHEMA_MIGRATIONS[version:]:
+                    getattr(self, migration)(c)
+            c.execute("PRAGMA user_version = %d;" % \
+              TodoDatabase.SCHEMA_VERSION)
+        # Readers and the writer do not block each other with WAL.  This is
+        # persistent, but cannot be changed inside a transaction.
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+
+    @staticmethod
+    def _executescript(c, script):
+        # Connection.executescript() would commit the current transaction.
+        statement = ""
+        for line in script.splitlines(True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                c.execute(statement)
+                statement = ""
+
+    def _create(self, c):
+        TodoDatabase._executescript(c, "%s %s %s %s %s %s %s %s %s" % ( \
+            TodoDatabase.SQL_TODO_TABLE,                        \
+            TodoDatabase.SQL_TODO_TABLE_INDEXES,                \
+            TodoDatabase.SQL_TODO_TABLE_TRIGGERS,               \
+            TodoDatabase.SQL_ARCHIVE_TABLE,                     \
+            TodoDatabase.SQL_TAGNAMES_TABLE,                    \
+            TodoDatabase.SQL_TAGS_TABLE,                        \
+            TodoDatabase.SQL_TAGS_TABLE_INDEXES,                \
+            TodoDatabase.SQL_TAGS_TABLE_TRIGGERS,               \
+            TodoDatabase.SQL_TEMPLATES_TABLE                    \
+        ))
+        TodoDatabase._executescript(c, TodoDatabase.SQL_MATERIALIZED_TABLES)
+        TodoDatabase._executescript(c, TodoDatabase.SQL_CHANGELOG_TABLE + \
+          TodoDatabase.SQL_CHANGELOG_TRIGGERS)
+        TodoDatabase._executescript(c, TodoDatabase.SQL_SETTINGS_TABLE)
+        self._createfts(c)
+
+    def _createfts(self, c):
+        try:
+            TodoDatabase._executescript(c, TodoDatabase.SQL_FTS5_TABLE + \
+              TodoDatabase.SQL_FTS5_TABLE_TRIGGERS)
+        except sqlite3.OperationalError:
+            TodoDatabase._executescript(c, TodoDatabase.SQL_FTS4_TABLE + \
+              TodoDatabase.SQL_FTS4_TABLE_TRIGGERS)
+        c.execute("INSERT INTO todo_fts (todo_fts) VALUES ('rebuild');")
+
+    def _migrate1(self, c):
+        self._createfts(c)
+
+    def _migrate2(self, c):
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TODO_TABLE_INDEXES)
+        TodoDatabase._executescript(c, TodoDatabase.SQL_MATERIALIZED_TABLES)
+
+    def _migrate3(self, c):
+        # Nothing to do in the transaction, _upgrade() switches to WAL.
+        pass
+
+    def _migrate4(self, c):
+        for trigger in ('trigger_update_todo', 'trigger_update_tags',
+          'trigger_insert_tags', 'trigger_delete_tags'):
+            c.execute("DROP TRIGGER IF EXISTS %s;" % trigger)
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TODO_TABLE_TRIGGERS)
+
+    def _migrate5(self, c):
+        # Superseded by the composite completion indexes.
+        c.execute("DROP INDEX IF EXISTS index_completion;")
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TODO_TABLE_INDEXES)
+
+    def _migrate6(self, c):
+        c.execute("DROP INDEX IF EXISTS index_tag_todokey;")
+        c.execute("DROP INDEX IF EXISTS index_todokey;")
+        c.execute("ALTER TABLE tags RENAME TO oldtags;")
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TAGNAMES_TABLE + \
+          TodoDatabase.SQL_TAGS_TABLE)
+        # Counts are computed once at the end rather than by the triggers.
+        c.execute("""
+        INSERT INTO tagnames (name)
+        SELECT DISTINCT tag FROM oldtags WHERE tag IS NOT NULL;
+        """)
+        c.execute("""
+        INSERT OR IGNORE INTO tags (todokey, tagkey)
+        SELECT oldtags.todokey, tagnames.tagkey
+        FROM oldtags JOIN tagnames ON tagnames.name = oldtags.tag
+        WHERE oldtags.todokey IN (SELECT rowid FROM todo);
+        """)
+        c.execute("""
+        UPDATE tagnames
+        SET uses = (SELECT count(*) FROM tags
+                    WHERE tags.tagkey = tagnames.tagkey);
+        """)
+        c.execute("DELETE FROM tagnames WHERE uses = 0;")
+        c.execute("DROP TABLE oldtags;")
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TAGS_TABLE_INDEXES + \
+          TodoDatabase.SQL_TAGS_TABLE_TRIGGERS)
+
+    def _migrate7(self, c):
+        TodoDatabase._executescript(c, TodoDatabase.SQL_CHANGELOG_TABLE)
+        # Everything already there is a change for a new copy.
+        c.execute("""
+        INSERT INTO changelog (tbl, key) SELECT 'todo', rowid FROM todo;
+        """)
+        c.execute("""
+        INSERT INTO changelog (tbl, key, name)
+        SELECT 'tags', tags.todokey, tagnames.name
+        FROM tags JOIN tagnames ON tagnames.tagkey = tags.tagkey;
+        """)
+        c.execute("""
+        INSERT INTO changelog (tbl, key) SELECT 'archive', rowid FROM archive;
+        """)
+        TodoDatabase._executescript(c, TodoDatabase.SQL_CHANGELOG_TRIGGERS)
+
+    def _migrate8(self, c):
+        TodoDatabase._executescript(c, TodoDatabase.SQL_SETTINGS_TABLE)
+
+    def _migrate9(self, c):
+        c.execute("DROP TRIGGER IF EXISTS trigger_update_todo;")
+        TodoDatabase._executescript(c, TodoDatabase.SQL_TODO_TABLE_TRIGGERS)
+
+    def _migrate10(self, c):
+        columns = TodoDatabase.CHANGELOG_COLUMNS + ('archivetime', 'tags')
+        c.execute("DROP TRIGGER IF EXISTS trigger_log_insert_archive;")
+        c.execute("ALTER TABLE archive RENAME TO oldarchive;")
+        TodoDatabase._executescript(c, TodoDatabase.SQL_ARCHIVE_TABLE)
+        # The rowids logged so far are kept as keys.
+        c.execute("""
+        INSERT INTO archive (archivekey, {columns})
+        SELECT rowid, {columns} FROM oldarchive;
+        """.format(columns=', '.join(columns)))
+        c.execute("DROP TABLE oldarchive;")
+        # Keys of items already moved to partitions are not reused either.
+        c.execute("""
+        SELECT max(key) AS maxkey FROM changelog WHERE tbl = 'archive';
+        """)
+        maxkey = c.fetchone()['maxkey']
+        if maxkey is not None:
+            c.execute("DELETE FROM sqlite_sequence WHERE name = 'archive';")
+            c.execute("""
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'archive', max(?, ifnull(max(archivekey), 0))
+            FROM archive;
+            """, (maxkey,))
+        TodoDatabase._executescript(c, TodoDatabase.SQL_CHANGELOG_TRIGGERS)
+
+    def _ftsversion(self):
+        if self._fts is None:
+            c = self._conn.cursor()
+            c.execute("""
+            SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;
+            """, ('todo_fts',))
+            self._fts = 5 if 'fts5' in c.fetchone()['sql'].lower() else 4
+            if self._fts == 4:
+                self._conn.create_function("ftsrank", 1,
+                  TodoDatabase._fts4rank)
+        return self._fts
+
+    @staticmethod
+    def _fts4rank(matchinfo):
+        # Sum of hits in this row over hits in all rows, for each phrase
+        # and column, from matchinfo(todo_fts, 'pcx').  Negated so that,
+        # like FTS5 rank, lower is better.
+        info = struct.unpack("@%dI" % (len(matchinfo) / 4), matchinfo)
+        nphrase, ncol = info[0], info[1]
+        score = 0.0
+        for i in range(nphrase * ncol):
+            hits, allhits = info[2 + 3 * i], info[3 + 3 * i]
+            if hits > 0:
+                score += float(hits) / allhits
+        return -score
+
+    def _ftsquery(self, words, column=None):
+        """Build a MATCH expression requiring every word as a prefix."""
+        terms = []
+        for word in words:
+            if self._ftsversion() == 5:
+                term = '"%s" *' % word.replace('"', '""')
+                if column is not None:
+                    term = "%s : %s" % (column, term)
+                terms.append(term)
+            else:
+                # FTS4 column filters do not apply to phrases.
+                for token in re.findall(r'[^\s!-/:-@\[-`{-~]+', word):
+                    if column is not None:
+                        token = "%s:%s" % (column, token)
+                    terms.append(token + '*')
+        if len(terms) == 0:
+            raise ValueError("Nothing to search for")
+        return ' '.join(terms)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one write transaction.
+
+        Nested uses join the outermost transaction.
+        """
+        c = self._conn.cursor()
+        if self._txdepth > 0:
+            self._txdepth += 1
+            try:
+                yield c
+            finally:
+                self._txdepth -= 1
+            return
+
+        self._begin(c)
+        self._txdepth = 1
+        try:
+            yield c
+        except:
+            self._txdepth = 0
+            c.execute("ROLLBACK;")
+            raise
+        self._txdepth = 0
+        c.execute("COMMIT;")
+        if self._maintainevery > 0:
+            self._automaintain()
+
+    def _begin(self, c):
+        # The busy handler is not always called, e.g. while another
+        # connection recovers the WAL, so retry with backoff as well.
+        deadline = time.time() + self._timeout
+        delay = 0.01
+        while True:
+            try:
+                c.execute("BEGIN IMMEDIATE;")
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                if time.time() + delay > deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def add(self, item):
+        with self.transaction() as c:
+            c.execute("""
+            INSERT INTO todo (deadline, title, completion, priority)
+            VALUES (?, ?, ?, ?);
+            """, (item.deadline.get(), item.title.get(),
+               item.completion.get(), item.priority.get()))
+            rowid = c.lastrowid
+            TodoDatabase._addtags(c, [(rowid, tag) for tag in item.tags])
+        return rowid
+
+    def add_many(self, items):
+        """Insert all items in a single transaction; return the rowids."""
+        items = list(items)
+        if len(items) == 0:
+            return []
+        with self.transaction() as c:
+            c.execute("SELECT ifnull(max(rowid), 0) AS maxid FROM todo;")
+            maxid = c.fetchone()['maxid']
+            c.executemany("""
+            INSERT INTO todo (deadline, title, description, completion,
+                              priority)
+            VALUES (?, ?, ?, ?, ?);
+            """, [(item.deadline.get(), item.title.get(),
+                   item.description.get(), item.completion.get(),
+                   item.priority.get()) for item in items])
+            # Rowids are allocated in insertion order above the previous
+            # maximum, and the write lock is held since BEGIN IMMEDIATE.
+            c.execute("""
+            SELECT rowid FROM todo WHERE rowid > ? ORDER BY rowid;
+            """, (maxid,))
+            rowids = [row['rowid'] for row in c.fetchall()]
+            TodoDatabase._addtags(c, [(rowid, tag)
+              for rowid, item in zip(rowids, items) for tag in item.tags])
+        return rowids
+
+    @staticmethod
+    def _addtags(c, pairs):
+        """Attach tags to items, given as (rowid, tag name) pairs."""
+        if len(pairs) == 0:
+            return
+        c.executemany("""
+        INSERT OR IGNORE INTO tagnames (name) VALUES (?);
+        """, [(name,) for name in set(tag for rowid, tag in pairs)])
+        c.executemany("""
+        INSERT OR IGNORE INTO tags (todokey, tagkey)
+        SELECT ?, tagkey FROM tagnames WHERE name = ?;
+        """, pairs)
+
+    @staticmethod
+    def _modified(item):
+        columns = []
+        for column in ("title", "description", "completion", "deadline",
+          "priority"):
+            prop = getattr(item, column)
+            if prop.isModified():
+                columns.append((column, prop.get()))
+        return columns
+
+    @staticmethod
+    def _updatequery(columns, where):
+        query = "UPDATE todo SET "
+        query += "".join(map(lambda t: "%s = ?, " % t[0], columns))
+        query += "updates = updates + 1, lastupdate = CURRENT_TIMESTAMP"
+        return query + " WHERE " + where
+
+    def update(self, item):
+        columns = TodoDatabase._modified(item)
+        tags, untags = item.tags.difference()
+        if len(columns) == 0 and len(tags) == 0 and len(untags) == 0:
+            return
+
+        with self.transaction() as c:
+            params = map(lambda t: t[1], columns)
+            params.append(item.rowid.get())
+            c.execute(TodoDatabase._updatequery(columns, "rowid = ?"), params)
+
+            TodoDatabase._addtags(c, [(item.rowid.get(), tag) for tag in tags])
+            if len(untags) > 0:
+                c.execute("""
+                DELETE FROM tags
+                WHERE todokey = ? AND tagkey IN (
+                    SELECT tagkey FROM tagnames WHERE name IN ({taglist})
+                );
+                """.format(taglist=', '.join(['?'] * len(untags))),
+                  [item.rowid.get()] + list(untags))
+
+    def update_many(self, modification, ids=[], item=None, tags=(),
+      untags=()):
+        """Update items by rowid and/or properties; return their count.
+
+        Items are selected as in delete().  The modified properties of
+        modification are set on all of them, tags are attached and untags
+        removed, with one statement for each.
+        """
+        querycond, params = self._selectcond(ids, item)
+        return self._updateall("""
+        SELECT todo.rowid AS todokey FROM todo WHERE %s
+        """ % " AND ".join(querycond), params, modification, tags, untags)
+
+    def update_raw(self, modification, querycond, params=[], tags=(),
+      untags=()):
+        """Like update_many(), for the items matching querycond."""
+        return self._updateall("""
+        SELECT rowid AS todokey FROM (%s%s)
+        """ % (TodoDatabase.SQL_JOIN_QUERY, querycond), params,
+          modification, tags, untags)
+
+    def _updateall(self, query, params, modification, tags, untags):
+        columns = TodoDatabase._modified(modification)
+        if len(columns) == 0 and len(tags) == 0 and len(untags) == 0:
+            raise ValueError("Nothing to update")
+        with self.transaction() as c:
+            # Selected once and for all, as the changes may affect the
+            # selection, e.g. when removing the tag it is based on.
+            c.execute("DROP TABLE IF EXISTS temp.updating;")
+            c.execute("CREATE TEMP TABLE updating AS " + query + ";", params)
+            c.execute("SELECT count(*) AS count FROM temp.updating;")
+            count = c.fetchone()['count']
+            c.execute(TodoDatabase._updatequery(columns,
+              "rowid IN (SELECT todokey FROM temp.updating)"),
+              map(lambda t: t[1], columns))
+            # Tag names are only created for items to attach them to: no
+            # tags row, no trigger to delete them once unused.
+            if len(tags) > 0 and count > 0:
+                c.executemany("""
+                INSERT OR IGNORE INTO tagnames (name) VALUES (?);
+                """, [(tag,) for tag in tags])
+                c.execute("""
+                INSERT OR IGNORE INTO tags (todokey, tagkey)
+                SELECT updating.todokey, tagnames.tagkey
+                FROM temp.updating, tagnames
+                WHERE tagnames.name IN ({taglist});
+                """.format(taglist=', '.join(['?'] * len(tags))), list(tags))
+            if len(untags) > 0:
+                c.execute("""
+                DELETE FROM tags
+                WHERE todokey IN (SELECT todokey FROM temp.updating)
+                  AND tagkey IN (
+                    SELECT tagkey FROM tagnames WHERE name IN ({taglist})
+                );
+                """.format(taglist=', '.join(['?'] * len(untags))),
+                  list(untags))
+            c.execute("DROP TABLE temp.updating;")
+        return count
+
+    def _selectcond(self, ids, item):
+        querycond = []
+        params = []
+        if len(ids) > 0:
+            querycond, params = TodoDatabase._idscond(ids)
+        if item is not None:
+            itemcond, itemparams = self._getcond(item)
+            querycond += itemcond
+            params += itemparams
+        if len(querycond) == 0:
+            raise ValueError("No item given")
+        return querycond, params
+
+    def delete(self, ids=[], item=None):
+        """Archive and delete items by rowid and/or properties.
+
+        Each element of ids is either a rowid or a (first, last) tuple
+        standing for an inclusive range of rowids.  If item is given, only
+        the items matching its modified properties, as in get(), are
+        deleted.
+        """
+        querycond, params = self._selectcond(ids, item)
+        return self._archive(TodoDatabase._itemquery(querycond), params)
+
+    def delete_raw(self, querycond, params=[]):
+        """Archive and delete items matching querycond; return the count."""
+        return self._archive(TodoDatabase.SQL_JOIN_QUERY + querycond, params)
+
+    def _archive(self, query, params):
+        with self.transaction() as c:
+            c.execute("DROP TABLE IF EXISTS temp.archiving;")
+            c.execute("CREATE TEMP TABLE archiving AS " + query + ";", params)
+            c.execute("""
+            INSERT INTO archive (creation, lastupdate, updates, deadline,
+                                 title, description, completion, priority,
+                                 tags)
+            SELECT creation, lastupdate, updates, deadline, title,
+                   description, completion, priority, tags
+            FROM temp.archiving;
+            """)
+            count = c.rowcount
+            c.execute("""
+            DELETE FROM todo WHERE rowid IN (SELECT rowid FROM temp.archiving);
+            """)
+            c.execute("""
+            DELETE FROM tags
+            WHERE todokey IN (SELECT rowid FROM temp.archiving);
+            """)
+            c.execute("DROP TABLE temp.archiving;")
+        return count
+
+    def _partitionfile(self, period):
+        return self._dbfile + TodoDatabase.PARTITION_SUFFIX % period
+
+    def partitions(self):
+        """Return the periods of the archive partitions, oldest first."""
+        prefix = self._partitionfile('')
+        periods = []
+        for path in glob.glob(prefix + '*'):
+            period = path[len(prefix):]
+            if re.match(r'^\d{4}(-\d{2})?$', period):
+                periods.append(period)
+        return sorted(periods)
+
+    @contextlib.contextmanager
+    def _attach(self, period, create=False):
+        """Attach the partition of period as "part" while in the block."""
+        if self._txdepth > 0:
+            raise ValueError("Cannot attach a partition in a transaction")
+        path = self._partitionfile(period)
+        if create and not os.path.exists(path):
+            conn = sqlite3.connect(path, self._timeout)
+            conn.execute(TodoDatabase.SQL_ARCHIVE_TABLE)
+            conn.commit()
+            conn.close()
+        c = self._conn.cursor()
+        c.execute("ATTACH DATABASE ? AS part;", (path,))
+        try:
+            yield c
+        finally:
+            c.execute("DETACH DATABASE part;")
+
+    @staticmethod
+    def _periodrange(period):
+        # First and last month covered by a partition or a from=/to= bound.
+        if not re.match(r'^\d{4}(-\d{2})?$', period):
+            raise ValueError("Invalid period: %s" % period)
+        if len(period) == 4:
+            return period + '-01', period + '-12'
+        return period, period
+
+    def _movepartitions(self, by):
+        c = self._conn.cursor()
+        c.execute("SELECT ifnull(max(rowid), 0) AS maxid FROM archive;")
+        maxid = c.fetchone()['maxid']
+        c.execute("""
+        SELECT DISTINCT strftime(?, archivetime) AS period
+        FROM archive
+        WHERE rowid <= ? AND archivetime IS NOT NULL;
+        """, (TodoDatabase.PARTITION_PERIODS[by], maxid))
+        moved = 0
+        for period in [row['period'] for row in c.fetchall()]:
+            cond = """
+            FROM main.archive
+            WHERE rowid <= ? AND strftime(?, archivetime) = ?
+            """
+            params = (maxid, TodoDatabase.PARTITION_PERIODS[by], period)
+            # The rows are copied and removed in two transactions, as
+            # each file commits on its own: a crash in between leaves
+            # them in both files, but never in none.
+            with self._attach(period, True):
+                with self.transaction() as c:
+                    c.execute("""
+                    INSERT INTO part.archive (creation, lastupdate, updates,
+                                              deadline, title, description,
+                                              completion, priority,
+                                              archivetime, tags)
+                    SELECT creation, lastupdate, updates, deadline, title,
+                           description, completion, priority, archivetime,
+                           tags
+                    %s;
+                    """ % cond, params)
+                    moved += c.rowcount
+            with self.transaction() as c:
+                c.execute("DELETE %s;" % cond, params)
+        return moved
+
+    def _mergepartitions(self):
+        merged = 0
+        for period in self.partitions():
+            if len(period) == 4:
+                continue
+            with self._attach(period[0:4], True) as c:
+                c.execute("ATTACH DATABASE ? AS src;",
+                  (self._partitionfile(period),))
+                try:
+                    with self.transaction() as c:
+                        c.execute("""
+                        INSERT INTO part.archive (creation, lastupdate,
+                                                  updates, deadline, title,
+                                                  description, completion,
+                                                  priority, archivetime, tags)
+                        SELECT creation, lastupdate, updates, deadline,
+                               title, description, completion, priority,
+                               archivetime, tags
+                        FROM src.archive;
+                        """)
+                finally:
+                    c.execute("DETACH DATABASE src;")
+            self._droppartition(period)
+            merged += 1
+        return merged
+
+    def _droppartition(self, period):
+        path = self._partitionfile(period)
+        for suffix in ('-wal', '-shm', '-journal', ''):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    def compact(self, by='month', drop=None):
+        """Move archived items into partitions and tidy them up.
+
+        Archived items are moved out of the database into one partition
+        per month or year, as by says.  Monthly partitions are merged
+        into yearly ones when by is 'year'.  Partitions entirely older
+        than drop, a YYYY or YYYY-MM period, are deleted.  Returns the
+        number of items moved, partitions merged and partitions dropped.
+        """
+        if by not in TodoDatabase.PARTITION_PERIODS:
+            raise ValueError("Unknown partition period: %s" % by)
+        moved = self._movepartitions(by)
+        merged = 0
+        if by == 'year':
+            merged = self._mergepartitions()
+        dropped = 0
+        if drop is not None:
+            first, last = TodoDatabase._periodrange(drop)
+            for period in self.partitions():
+                if TodoDatabase._periodrange(period)[1] < first:
+                    self._droppartition(period)
+                    dropped += 1
+        return moved, merged, dropped
+
+    @staticmethod
+    def _historycond(item):
+        # Archived items have no full-text index nor tag table.
+        querycond = []
+        params = []
+        if item.title.isModified():
+            for word in item.title.get().split():
+                querycond.append("title LIKE ?")
+                params.append('%' + word + '%')
+        for column in ("completion", "deadline", "priority"):
+            prop = getattr(item, column)
+            if not prop.isModified():
+                continue
+            if prop.get() is None:
+                querycond.append("%s IS NULL" % column)
+            else:
+                querycond.append("%s = ?" % column)
+                params.append(prop.get())
+        if item.tags.isModified():
+            querycond.append("(%s)" % " OR ".join(
+              ["',' || tags || ',' LIKE ?"] * item.tags.len()))
+            params += ['%,' + tag + ',%' for tag in item.tags]
+        return querycond, params
+
+    def iterhistory(self, item, start=None, end=None):
+        """Like history(), but yield items as they are fetched."""
+        querycond, params = TodoDatabase._historycond(item)
+        first, last = '0000-00', '9999-99'
+        if start is not None:
+            first = TodoDatabase._periodrange(start)[0]
+            querycond.append("substr(archivetime, 1, 7) >= ?")
+            params.append(first)
+        if end is not None:
+            last = TodoDatabase._periodrange(end)[1]
+            querycond.append("substr(archivetime, 1, 7) <= ?")
+            params.append(last)
+        query = """
+        SELECT NULL AS rowid, creation, lastupdate, updates, deadline, title,
+               description, completion, priority, tags
+        FROM {db}.archive
+        {where}
+        ORDER BY archivetime, rowid
+        """.format(db='{db}', where="WHERE " + " AND ".join(querycond)
+          if len(querycond) > 0 else "")
+
+        for period in self.partitions():
+            pfirst, plast = TodoDatabase._periodrange(period)
+            if plast < first or pfirst > last:
+                continue
+            with self._attach(period):
+                records = self._iteritems(query.format(db='part'), params)
+                try:
+                    for record in records:
+                        yield record
+                finally:
+                    # Finalize the statement before detaching.
+                    records.close()
+        for record in self._iteritems(query.format(db='main'), params):
+            yield record
+
+    def history(self, item, start=None, end=None):
+        """Return the archived items matching item's modified fields.
+
+        Archive partitions are searched too, oldest first, restricted to
+        those covering the start and end periods (YYYY or YYYY-MM) when
+        given.  Title words match anywhere in the title.
+        """
+        return list(self.iterhistory(item, start, end))
+
+    @staticmethod
+    def _idscond(ids):
+        querycond = []
+        params = []
+        single = []
+        for rowid in ids:
+            if isinstance(rowid, tuple):
+                querycond.append("todo.rowid BETWEEN ? AND ?")
+                params += [int(rowid[0]), int(rowid[1])]
+            else:
+                single.append(int(rowid))
+        if len(single) > 0:
+            querycond.append("todo.rowid IN ({idslist})".format(
+              idslist=', '.join(['?'] * len(single))))
+            params += single
+        if len(querycond) == 0:
+            raise ValueError("No item given")
+        return ["(" + " OR ".join(querycond) + ")"], params
+
+    @staticmethod
+    def _itemquery(querycond, tail="ORDER BY todo.rowid"):
+        where = ""
+        if len(querycond) > 0:
+            where = "WHERE " + " AND ".join(querycond)
+        return TodoDatabase.SQL_ITEM_QUERY.format(where=where, tail=tail)
+
+    @staticmethod
+    def _viewquery(querycond):
+        # SQL_JOIN_QUERY restricted to the items matching querycond, for
+        # raw conditions to be appended.
+        return "SELECT * FROM (%s)" % TodoDatabase._itemquery(querycond)
+
+    def _iteritems(self, query, params=[]):
+        """Yield a TodoRecord for each row of query."""
+        c = self._conn.cursor()
+        c.row_factory = None
+        c.execute(query + ";", params)
+        ncolumns = len(TodoRecord._fields)
+        trim = len(c.description) != ncolumns
+        make = TodoRecord._make
+        while True:
+            rows = c.fetchmany(TodoDatabase.FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            if trim:
+                rows = [row[:ncolumns] for row in rows]
+            for record in map(make, rows):
+                yield record
+
+    def _items(self, query, params=[]):
+        return list(self._iteritems(query, params))
+
+    def iter_raw(self, querycond, params=[]):
+        """Like get_raw(), but yield items as they are fetched."""
+        return self._iteritems(TodoDatabase.SQL_JOIN_QUERY + querycond, params)
+
+    def get_raw(self, querycond, params=[]):
+        return list(self.iter_raw(querycond, params))
+
+    def get_id(self, rowid):
+        """Return the updatable TodoItem with this rowid, or None."""
+        c = self._conn.cursor()
+        c.execute(TodoDatabase._itemquery(["todo.rowid = ?"]) + ";",
+          (int(rowid),))
+        row = c.fetchone()
+        if row is None:
+            return None
+        return TodoItem.fromRow(row)
+
+    def _getcond(self, item):
+        """Return the conditions on todo matching item's modified fields."""
+        querycond = []
+        params = []
+
+        fts = []
+        if item.title.isModified():
+            fts.append(self._ftsquery(item.title.get().split(), "title"))
+        if item.description.isModified():
+            fts.append(self._ftsquery(item.description.get().split(),
+              "description"))
+        if len(fts) > 0:
+            querycond.append("""
+                todo.rowid IN (
+                    SELECT rowid FROM todo_fts WHERE todo_fts MATCH ?
+                )
+            """)
+            params.append(' '.join(fts))
+
+        for column in ("completion", "deadline", "priority"):
+            prop = getattr(item, column)
+            if not prop.isModified():
+                continue
+            if prop.get() is None:
+                querycond.append("todo.%s IS NULL" % column)
+            else:
+                querycond.append("todo.%s = ?" % column)
+                params.append(prop.get())
+
+        if item.tags.isModified():
+            querycond.append("""
+                todo.rowid IN (
+                    SELECT todokey
+                    FROM tags
+                    WHERE tagkey IN (
+                        SELECT tagkey FROM tagnames WHERE name IN ({taglist})
+                    )
+                )
+            """.format(taglist=', '.join(['?'] * item.tags.len())))
+            params += map(lambda x: x, item.tags)
+
+        return querycond, params
+
+    @staticmethod
+    def _sortkey(order):
+        if order is None:
+            return "todo.rowid", "ASC", 'rowid'
+        key = order.lstrip('-')
+        if key not in TodoDatabase.SORT_KEYS:
+            raise ValueError("Unknown sort key: %s" % key)
+        return TodoDatabase.SORT_KEYS[key], \
+          "DESC" if order[0:1] == '-' else "ASC", key
+
+    @staticmethod
+    def sortvalue(record, order=None):
+        """Return the (value, rowid) by which get() sorts record."""
+        expr, direction, key = TodoDatabase._sortkey(order)
+        value = getattr(record, key)
+        if value is None:
+            value = float('inf') if key == 'deadline' else 0
+        return value, record.rowid
+
+    @staticmethod
+    def pagecursor(record, order=None):
+        """Return the after argument of get() for the page after record."""
+        return base64.urlsafe_b64encode(json.dumps(
+          list(TodoDatabase.sortvalue(record, order))))
+
+    def _pagequery(self, item, order, limit, offset, after):
+        querycond, params = self._getcond(item)
+        expr, direction, key = TodoDatabase._sortkey(order)
+        if after is not None:
+            value, rowid = json.loads(base64.urlsafe_b64decode(str(after)))
+            cmp = '<' if direction == "DESC" else '>'
+            if key == 'rowid':
+                querycond.append("todo.rowid %s ?" % cmp)
+                params.append(rowid)
+            else:
+                # Rather than a row value, so that the index is searched.
+                querycond.append("(%s %s ? OR (%s = ? AND todo.rowid %s ?))" \
+                  % (expr, cmp, expr, cmp))
+                params += [value, value, rowid]
+        tail = "ORDER BY %s %s" % (expr, direction)
+        if key != 'rowid':
+            tail += ", todo.rowid %s" % direction
+        if limit is not None or offset is not None:
+            tail += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset or 0]
+        return TodoDatabase._itemquery(querycond, tail), params
+
+    def iter(self, item, order=None, limit=None, offset=None, after=None):
+        """Like get(), but yield items as they are fetched."""
+        query, params = self._pagequery(item, order, limit, offset, after)
+        return self._iteritems(query, params)
+
+    def get(self, item, order=None, limit=None, offset=None, after=None):
+        """Return the items matching item's modified fields.
+
+        Items are sorted by rowid, or by order, one of the SORT_KEYS,
+        descending if prefixed with '-'.  limit and offset select a page;
+        after, as returned by pagecursor(), starts after a given item
+        without counting the items before it.
+        """
+        return list(self.iter(item, order, limit, offset, after))
+
+    def search(self, words):
+        """Return the items matching all words, best matches first."""
+        if self._ftsversion() == 5:
+            ftsselect = "SELECT rowid AS ftsid, rank AS ftsrank"
+        else:
+            ftsselect = """
+            SELECT docid AS ftsid,
+                   ftsrank(matchinfo(todo_fts, 'pcx')) AS ftsrank
+            """
+        match = self._ftsquery(words)
+        query = """
+        SELECT items.*
+        FROM (%s) AS items JOIN (
+            %s
+            FROM todo_fts
+            WHERE todo_fts MATCH ?
+        ) AS fts ON items.rowid = fts.ftsid
+        ORDER BY fts.ftsrank, items.rowid
+        """ % (TodoDatabase._itemquery(["""
+            todo.rowid IN (
+                SELECT rowid FROM todo_fts WHERE todo_fts MATCH ?
+            )
+        """]), ftsselect)
+        return self._items(query, (match, match))
+
+    def stats(self):
+        """Return aggregate counts over the todo items, as a dict.
+
+        items and overdue (due before today and not complete) are
+        counts; completion holds the count of each COMPLETION_BUCKETS
+        range, priority the (priority, count) pairs and tags the result
+        of tags().  The result is computed in one scan of todo and kept
+        until the database changes or the day does.
+        """
+        c = self._conn.cursor()
+        c.row_factory = None
+        c.execute("PRAGMA data_version;")
+        # data_version only changes on commits of other connections.
+        today = time.mktime(time.localtime()[0:3] + (0, 0, 0, 0, 0, -1))
+        key = (c.fetchone()[0], self._conn.total_changes, today)
+        if self._stats is not None and self._stats[0] == key:
+            return self._stats[1]
+
+        buckets = TodoDatabase.COMPLETION_BUCKETS
+        c.execute("""
+        SELECT ifnull(priority, 0), count(*),
+               sum(deadline < ? AND ifnull(completion, 0) < 100), %s
+        FROM todo
+        GROUP BY ifnull(priority, 0)
+        ORDER BY ifnull(priority, 0);
+        """ % ', '.join(["sum(ifnull(completion, 0) BETWEEN %d AND %d)" % \
+          bucket for bucket in buckets]), (today,))
+        stats = {
+            'items': 0,
+            'overdue': 0,
+            'completion': [(bucket, 0) for bucket in buckets],
+            'priority': []
+        }
+        for row in c.fetchall():
+            stats['items'] += row[1]
+            stats['overdue'] += row[2] or 0
+            stats['completion'] = [(bucket, count + (n or 0))
+              for (bucket, count), n in zip(stats['completion'], row[3:])]
+            stats['priority'].append((row[0], row[1]))
+        stats['tags'] = self.tags()
+        self._stats = (key, stats)
+        return stats
+
+    def tags(self):
+        """Return the (name, number of items) of all tags, by name."""
+        c = self._conn.cursor()
+        c.execute("SELECT name, uses FROM tagnames ORDER BY name;")
+        return [(row['name'], row['uses']) for row in c.fetchall()]
+
+    def export(self, since=0):
+        """Yield the changes after seq since, oldest first.
+
+        Each change is a dict holding its seq, the table ('todo', 'tags'
+        or 'archive') and the key (rowid, todo rowid for tags, or
+        archivekey) it applies to, the tag name for tags, and either
+        deleted set to True or, for todo and archive, the current row.
+        Feed them to apply() on another copy of the database.
+        """
+        columns = TodoDatabase.CHANGELOG_COLUMNS
+        c = self._conn.cursor()
+        c.row_factory = None
+        c.execute("""
+        SELECT changelog.seq, changelog.tbl, changelog.key, changelog.name,
+               changelog.deleted, archive.archivekey IS NOT NULL, {todo},
+               {archive}, archive.archivetime, archive.tags
+        FROM changelog
+        LEFT JOIN todo
+            ON changelog.tbl = 'todo' AND todo.rowid = changelog.key
+        LEFT JOIN archive
+            ON changelog.tbl = 'archive' AND archive.archivekey = changelog.key
+        WHERE changelog.seq > ?
+        ORDER BY changelog.seq;
+        """.format(todo=', '.join(['todo.' + col for col in columns]),
+          archive=', '.join(['archive.' + col for col in columns])),
+          (since,))
+        ncolumns = len(columns)
+        while True:
+            rows = c.fetchmany(TodoDatabase.FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                change = {'seq': row[0], 'table': row[1], 'key': row[2]}
+                if row[1] == 'tags':
+                    change['tag'] = row[3]
+                if row[4]:
+                    change['deleted'] = True
+                elif row[1] == 'tags':
+                    pass
+                elif row[1] == 'todo':
+                    change['row'] = dict(zip(columns, row[6:6 + ncolumns]))
+                elif row[5]:
+                    change['row'] = dict(zip(columns + ('archivetime',
+                      'tags'), row[6 + ncolumns:]))
+                else:
+                    # Moved to a partition since.
+                    continue
+                yield change
+
+    def apply(self, changes):
+        """Apply changes, as yielded by export(), in one transaction.
+
+        Items are stored as they are in the source, but for lastupdate:
+        items changed here, tags included, get the local time so that
+        materialized templates check them again on their next refresh.
+        Returns the seq of the last change, or None if there was none.
+        """
+        columns = TodoDatabase.CHANGELOG_COLUMNS
+        seq = None
+        changed = set()
+        with self.transaction() as c:
+            for change in changes:
+                table, key = change['table'], change['key']
+                if table == 'todo' and change.get('deleted'):
+                    c.execute("DELETE FROM todo WHERE rowid = ?;", (key,))
+                elif table == 'todo':
+                    values = [change['row'][col] for col in columns]
+                    c.execute("UPDATE todo SET %s WHERE rowid = ?;" % \
+                      ', '.join(["%s = ?" % col for col in columns]),
+                      values + [key])
+                    if c.rowcount == 0:
+                        c.execute("""
+                        INSERT INTO todo (rowid, %s) VALUES (?, %s);
+                        """ % (', '.join(columns),
+                          ', '.join(['?'] * len(columns))), [key] + values)
+                    changed.add(key)
+                elif table == 'tags' and change.get('deleted'):
+                    c.execute("""
+                    DELETE FROM tags
+                    WHERE todokey = ? AND tagkey IN (
+                        SELECT tagkey FROM tagnames WHERE name = ?
+                    );
+                    """, (key, change['tag']))
+                    changed.add(key)
+                elif table == 'tags':
+                    TodoDatabase._addtags(c, [(key, change['tag'])])
+                    changed.add(key)
+                elif table == 'archive' and not change.get('deleted'):
+                    acolumns = columns + ('archivetime', 'tags')
+                    c.execute("""
+                    INSERT OR IGNORE INTO archive (archivekey, %s)
+                    VALUES (?, %s);
+                    """ % (', '.join(acolumns),
+                      ', '.join(['?'] * len(acolumns))),
+                      [key] + [change['row'][col] for col in acolumns])
+                else:
+                    raise ValueError("Unknown change: %r" % change)
+                seq = change['seq']
+            # Neither trigger_update_todo nor the change log see this.
+            c.executemany("""
+            UPDATE todo SET lastupdate = CURRENT_TIMESTAMP WHERE rowid = ?;
+            """, [(key,) for key in changed])
+        return seq
+
+    def templateadd(self, name, query):
+        self._conn.cursor().execute("""
+        INSERT INTO templates (name, query) VALUES (?, ?);
+        """, (name, query))
+
+
+    def templatedel(self, name):
+        with self.transaction() as c:
+            c.execute("""
+            DELETE FROM materialized WHERE matkey IN (
+                SELECT matkey FROM materializations WHERE name = ?
+            );
+            """, (name,))
+            c.execute("""
+            DELETE FROM materializations WHERE name = ?;
+            """, (name,))
+            c.execute("""
+            DELETE FROM templates WHERE name = ?;
+            """, (name,))
+
+
+    def templateshow(self, names=[]):
+        c = self._conn.cursor()
+        query = "SELECT * FROM templates";
+        if len(names) > 0:
+            query += " WHERE name IN (" + ", ".join(["?"] * len(names)) + ")"
+        query += ';'
+        c.execute(query, names)
+        while True:
+            row = c.fetchone()
+            if row is None:
+                break
+            print "[%12s] %s" % (row['name'], row['query']);
+
+
+    def _templatequery(self, c, name):
+        c.execute("""
+        SELECT query FROM templates WHERE name = ?;
+        """, (name,))
+        row = c.fetchone()
+        if row is None:
+            raise ValueError("Unknown template: %s" % name)
+        return row['query']
+
+
+    def templatematerialize(self, name, params):
+        """Keep the result of the template for these params up to date.
+
+        The template condition must only depend on each item's own
+        columns for incremental refreshes to be exact: conditions on
+        the current time or with a LIMIT need templaterefresh(full=True).
+        """
+        with self.transaction() as c:
+            self._templatequery(c, name)
+            c.execute("""
+            INSERT OR IGNORE INTO materializations (name, params)
+            VALUES (?, ?);
+            """, (name, json.dumps(list(params))))
+        self.templaterefresh(name, True)
+
+
+    def templateunmaterialize(self, name):
+        with self.transaction() as c:
+            c.execute("""
+            DELETE FROM materialized WHERE matkey IN (
+                SELECT matkey FROM materializations WHERE name = ?
+            );
+            """, (name,))
+            c.execute("""
+            DELETE FROM materializations WHERE name = ?;
+            """, (name,))
+
+
+    def templaterefresh(self, name=None, full=False):
+        """Refresh the materializations of template name, or all of them."""
+        with self.transaction() as c:
+            query = """
+            SELECT matkey, params, refreshed, query
+            FROM materializations JOIN templates USING (name)
+            """
+            if name is not None:
+                c.execute(query + " WHERE name = ?;", (name,))
+            else:
+                c.execute(query + ";")
+            for row in c.fetchall():
+                refreshed = None if full else row['refreshed']
+                self._refresh(c, row['matkey'], row['query'],
+                  json.loads(row['params']), refreshed)
+
+
+    def _refresh(self, c, matkey, querycond, params, refreshed):
+        if refreshed is None:
+            c.execute("""
+            DELETE FROM materialized WHERE matkey = ?;
+            """, (matkey,))
+            query = TodoDatabase.SQL_JOIN_QUERY + querycond
+            changedparams = []
+        else:
+            # Items deleted or updated since the last refresh are dropped,
+            # and the latter checked again.  Timestamps have a resolution
+            # of one second, hence >=.
+            c.execute("""
+            DELETE FROM materialized
+            WHERE matkey = ? AND NOT EXISTS (
+                SELECT 1 FROM todo
+                WHERE todo.rowid = materialized.todokey
+                  AND todo.lastupdate < ?
+            );
+            """, (matkey, refreshed))
+            query = TodoDatabase._viewquery(["todo.lastupdate >= ?"]) + \
+              querycond
+            changedparams = [refreshed]
+        c.execute("""
+        INSERT OR IGNORE INTO materialized (matkey, todokey)
+        SELECT ?, rowid FROM (%s);
+        """ % query, [matkey] + changedparams + list(params))
+        c.execute("""
+        UPDATE materializations SET refreshed = CURRENT_TIMESTAMP
+        WHERE matkey = ?;
+        """, (matkey,))
+
+
+    def templatematerialized(self):
+        c = self._conn.cursor()
+        c.execute("""
+        SELECT name, params, refreshed,
+               (SELECT count(*) FROM materialized
+                WHERE matkey = materializations.matkey) AS items,
+               (SELECT count(*) FROM todo
+                WHERE lastupdate >= refreshed) AS changed
+        FROM materializations
+        ORDER BY name, params;
+        """)
+        for row in c.fetchall():
+            print "[%12s] %s: %d items, refreshed %s, %d changed since" % \
+              (row['name'], ' '.join(json.loads(row['params'])), row['items'],
+                row['refreshed'], row['changed'])
+
+
+    def templateiter(self, name, params):
+        """Like templaterun(), but yield items as they are fetched.
+
+        Materialized templates are refreshed first, then only the items
+        they hold are checked against the template condition.
+        """
+        c = self._conn.cursor()
+        query = self._templatequery(c, name)
+        c.execute("""
+        SELECT matkey, refreshed FROM materializations
+        WHERE name = ? AND params = ?;
+        """, (name, json.dumps(list(params))))
+        row = c.fetchone()
+        if row is None:
+            return self.iter_raw(query, params)
+
+        with self.transaction() as c:
+            self._refresh(c, row['matkey'], query, params, row['refreshed'])
+        return self._iteritems(TodoDatabase._viewquery(["""
+            todo.rowid IN (
+                SELECT todokey FROM materialized WHERE matkey = ?
+            )
+        """]) + query, [row['matkey']] + list(params))
+
+    def templaterun(self, name, params):
+        return list(self.templateiter(name, params))
+
+    def _setting(self, name, default=None):
+        c = self._conn.cursor()
+        c.execute("SELECT value FROM settings WHERE name = ?;", (name,))
+        row = c.fetchone()
+        return default if row is None else row['value']
+
+    def _changeseq(self, c):
+        # Every write shows in the change log, whose last seq is kept in
+        # sqlite_sequence.
+        c.execute("""
+        SELECT ifnull(max(seq), 0) AS seq
+        FROM sqlite_sequence WHERE name = 'changelog';
+        """)
+        return c.fetchone()['seq']
+
+    def _automaintain(self):
+        c = self._conn.cursor()
+        if self._changeseq(c) - self._setting('maintain_seq', 0) >= \
+          self._maintainevery:
+            self.maintain(check=False)
+
+    def setmaintain(self, every):
+        """Run maintain(check=False) after every writes; 0 disables it."""
+        with self.transaction() as c:
+            c.execute("""
+            INSERT OR REPLACE INTO settings (name, value)
+            VALUES ('maintain_every', ?);
+            """, (int(every),))
+        self._maintainevery = int(every)
+
+    def maintain(self, check=True, full=False):
+        """Keep the database file and query plans healthy; return a report.
+
+        Refreshes the planner statistics, compacts the full-text index,
+        releases free pages to the filesystem (for databases created with
+        incremental auto_vacuum), checkpoints the WAL, and if check is set
+        runs a quick integrity check, or a full one, including the
+        full-text index, with full.  Without check, as run automatically,
+        the full-text index is only merged by FTS_MERGE_PAGES rather than
+        rewritten entirely.  The report is a dict of the results, and
+        with check, of the page, freelist and per-table and index sizes.
+        """
+        report = {}
+        with self.transaction() as c:
+            c.execute("""
+            SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1';
+            """)
+            if c.fetchone()[0] == 0:
+                c.execute("ANALYZE;")
+            else:
+                c.execute("PRAGMA optimize;")
+            if check:
+                c.execute("""
+                INSERT INTO todo_fts (todo_fts) VALUES ('optimize');
+                """)
+            elif self._ftsversion() == 5:
+                c.execute("""
+                INSERT INTO todo_fts (todo_fts, rank) VALUES ('merge', ?);
+                """, (TodoDatabase.FTS_MERGE_PAGES,))
+            else:
+                c.execute("""
+                INSERT INTO todo_fts (todo_fts) VALUES (?);
+                """, ('merge=%d,8' % TodoDatabase.FTS_MERGE_PAGES,))
+            c.execute("PRAGMA freelist_count;")
+            freelist = c.fetchone()[0]
+            c.execute("PRAGMA incremental_vacuum;")
+            c.fetchall()
+            c.execute("PRAGMA freelist_count;")
+            report['vacuumed'] = freelist - c.fetchone()[0]
+            c.execute("""
+            INSERT OR REPLACE INTO settings (name, value)
+            VALUES ('maintain_seq', ?);
+            """, (self._changeseq(c),))
+
+        c = self._conn.cursor()
+        # Automatic runs must not wait for readers.
+        c.execute("PRAGMA wal_checkpoint(%s);" % \
+          ("TRUNCATE" if check else "PASSIVE"))
+        c.fetchall()
+        if check:
+            c.execute("PRAGMA integrity_check;" if full else \
+              "PRAGMA quick_check;")
+            report['integrity'] = [row[0] for row in c.fetchall()]
+            if full and self._ftsversion() == 5:
+                try:
+                    c.execute("""
+                    INSERT INTO todo_fts (todo_fts) VALUES ('integrity-check');
+                    """)
+                except sqlite3.DatabaseError as e:
+                    report['integrity'].append("todo_fts: %s" % e)
+        else:
+            # dbstat reads every page of the file.
+            return report
+
+        for pragma in ('page_size', 'page_count', 'freelist_count',
+          'auto_vacuum'):
+            c.execute("PRAGMA %s;" % pragma)
+            report[pragma] = c.fetchone()[0]
+        try:
+            c.execute("""
+            SELECT name, sum(pgsize) AS size FROM dbstat
+            GROUP BY name ORDER BY size DESC, name;
+            """)
+            report['sizes'] = [(row['name'], row['size'])
+              for row in c.fetchall()]
+        except sqlite3.OperationalError:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB.
+            report['sizes'] = None
+        return report
+
+    def settrace(self, hook, explain=False):
+        """Call hook(query, params, seconds, rows, plan) for each statement.
+
+        plan is the EXPLAIN QUERY PLAN output, as a list of lines, when
+        explain is set.  A None hook stops tracing.
+        """
+        self._conn.tracehook = hook
+        self._conn.traceplans = explain
+
+    def explain(self, item, order=None, limit=None, offset=None, after=None):
+        """Return the query plan of get() as a list of lines."""
+        query, params = self._pagequery(item, order, limit, offset, after)
+        return explainQuery(self._conn, query, params)
+
+    def explain_raw(self, querycond, params=[]):
+        return explainQuery(self._conn,
+          TodoDatabase.SQL_JOIN_QUERY + querycond, params)
+
+    def templateexplain(self, name, params):
+        """Return the query plan of the template, without materialization."""
+        query = self._templatequery(self._conn.cursor(), name)
+        return self.explain_raw(query, params)
+
+
+class TodoPool(object):
+    """Access to a database from several threads.
+
+    Each thread reads through a read-only TodoDatabase of its own, opened
+    on first use; with WAL, readers do not wait for each other nor for
+    the writer.  Writes go through a single TodoDatabase, which threads
+    get in turn, in the order they asked for it:
+
+        pool = TodoPool(dbfile)
+        with pool.reader() as todo:
+            items = todo.get(item)
+        with pool.writer() as todo:
+            todo.update(item)
+    """
+
+    def __init__(self, dbfile, timeout=BUSY_TIMEOUT, pragmas={}):
+        self._dbfile = dbfile
+        self._timeout = timeout
+        self._pragmas = pragmas
+        # Opened first, so that it upgrades the schema if needed.
+        self._writer = TodoDatabase(dbfile, False, timeout, shared=True,
+          pragmas=pragmas)
+        self._local = threading.local()
+        self._readers = []
+        self._mutex = threading.Lock()
+        self._waiting = collections.deque()
+        self._busy = False
+        self._owner = None
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Yield the read-only TodoDatabase of the current thread."""
+        todo = getattr(self._local, 'todo', None)
+        if todo is None:
+            todo = TodoDatabase(self._dbfile, True, self._timeout,
+              shared=True, pragmas=self._pragmas)
+            self._local.todo = todo
+            with self._mutex:
+                self._readers.append(todo)
+        yield todo
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Yield the TodoDatabase for writes, within one transaction.
+
+        Other threads wait for the block to end, in turn.  Nested uses
+        from the same thread join the outermost one.
+        """
+        me = threading.current_thread()
+        if self._owner is me:
+            self._depth += 1
+            try:
+                with self._writer.transaction():
+                    yield self._writer
+            finally:
+                self._depth -= 1
+            return
+
+        self._acquire()
+        self._owner = me
+        self._depth = 1
+        try:
+            with self._writer.transaction():
+                yield self._writer
+        finally:
+            self._depth = 0
+            self._owner = None
+            self._release()
+
+    def _acquire(self):
+        with self._mutex:
+            if not self._busy:
+                self._busy = True
+                return
+            event = threading.Event()
+            self._waiting.append(event)
+        event.wait()
+
+    def _release(self):
+        # Hand the writer over to the next thread in line, if any.
+        with self._mutex:
+            if len(self._waiting) > 0:
+                self._waiting.popleft().set()
+            else:
+                self._busy = False
+
+    def close(self):
+        """Close all connections; the pool must not be used any more."""
+        with self._mutex:
+            for todo in self._readers:
+                todo.close()
+            self._readers = []
+        self._writer.close()
+
+
+def usage(progname):
+    print """
+Usage: %s [-d dbfile ...] [-t timeout] [-o io] [--trace|--profile]
+         [--format table|json|tsv|csv] <command> [args]
+Commands:
+  schema
+  template add <name> <query ...>
+  template del <name>
+  template show <name ...>
+  template run <name> <params ...>
+  template materialize <name> <params ...>
+  template unmaterialize <name>
+  template refresh [name] [full]
+  template materialized
+  sql <query ...>
+  explain sql <query ...>
+  explain template <name> <params ...>
+  explain get [property ...]
+  add/insert <property ...>
+  import [file]
+  export [--since seq]
+  apply [file]
+  update/set <id> <property ...>
+  update/set <id|first-last ...> [property ...] --set <property ...>
+  update/set where <condition ...> --set <property ...>
+  get/print/list [property ...] [sort=[-]key] [limit=n] [offset=n]
+                 [after=cursor]
+  search <word ...>
+  tags
+  stats
+  maintain [full] [every=n]
+  history [property ...] [from=period] [to=period]
+  compact [month|year] [drop=period]
+  del/delete/rem/remove <id|first-last ...> [property ...]
+  del/delete/rem/remove where <condition ...>
+  edit <id>
+  serve
+Import reads one item per line from file (or stdin), either with the
+add syntax or as a JSON object with title, description, deadline,
+completion, priority and tags keys.
+Export writes the changes made after seq (all of them by default) as
+JSON lines, which apply reads from file (or stdin) into another copy of
+the database; apply prints the seq to export from next time.
+Compact moves archived items to one file per month or year next to the
+database, merging monthly files into yearly ones with year, and deletes
+the files older than drop=YYYY[-MM].  History searches archived items,
+in those files too, archived between from= and to= if given.
+Tags lists every tag along with the number of items it is attached to.
+Maintain updates the query planner statistics, frees unused pages,
+checks the database integrity (thoroughly with full) and reports its
+size; every=n also runs it, without checks, after every n changes.
+Stats counts the items, overdue ones, and items by completion, priority
+and tag.
+Listings can be sorted by deadline, priority, completion or lastupdate,
+descending with sort=-key.  A full page given with limit=n ends with the
+after=cursor argument leading to the next page, on stderr.
+-o (or the %s environment variable) sets the pager: one of %s, and/or
+comma-separated mmap_size=bytes, cache_size=pages (KiB if negative) or
+temp_store=memory|file.  Read-only commands open the database read-only.
+Several -d options, or a glob pattern (quoted), run get, sql, template
+run and stats against every database at once.  Listings are merged and
+tell each item's database; stats are summed after those of each one.
+--format writes listings as a table, or with every column as stored, as
+JSON lines, or as tab or comma separated values.
+--trace logs each SQL statement with its parameters, time and number of
+rows to stderr; --profile also logs their query plan.
+Materialized templates keep their result for the given params, and only
+check items updated since then again; refresh full re-runs them entirely.
+Serve keeps the database open and runs the commands of other invocations
+on the same database, through a Unix socket next to it; those given -t,
+-o, --trace or --profile open the database themselves.
+With --set, update changes all the items given by id and matching the
+properties before --set, or matching the condition, and prints their
+count; a plain "set" word is part of the title:
+  update #release-1.2 --set %%100
+  update where deadline < strftime('%%s', '2026-11-01') --set #q3
+Deleted items are moved to the archive table, for instance:
+  del where completion = 100 AND lastupdate < datetime('now', '-30 days')
+Property:
+  %%n    - completion set to n%%; remove with -%% in update
+  !n    - priority set to n; remove with -! in update
+  @date - deadline set to date, or relative: today, tomorrow, +3d, -1w,
+          +2m, +1y; remove with -@ in update
+  #tag  - add tag; remove with -#tag in update
+  word  - belongs to title; in get, matches the beginning of a title word
+""" % (progname, IO_ENVIRON, ', '.join(sorted(IO_PROFILES)))
+
+def printStats(stats):
+    print "Items:   %6d" % stats['items']
+    print "Overdue: %6d" % stats['overdue']
+    print "Completion:"
+    for (low, high), count in stats['completion']:
+        print "  %8s %6d" % ("%d%%" % low if low == high else \
+          "%d-%d%%" % (low, high), count)
+    print "Priority:"
+    for priority, count in stats['priority']:
+        print "  %7d! %6d" % (priority, count)
+    print "Tags:"
+    for name, uses in stats['tags']:
+        print "  %8d %s" % (uses, name)
+
+def mergeStats(results):
+    """Sum the stats() of several databases."""
+    total = {
+        'items': 0,
+        'overdue': 0,
+        'completion': [(bucket, 0)
+          for bucket in TodoDatabase.COMPLETION_BUCKETS]
+    }
+    priorities = collections.Counter()
+    tags = collections.Counter()
+    for stats in results:
+        total['items'] += stats['items']
+        total['overdue'] += stats['overdue']
+        total['completion'] = [(bucket, count + n) for (bucket, count), \
+          (other, n) in zip(total['completion'], stats['completion'])]
+        priorities.update(dict(stats['priority']))
+        tags.update(dict(stats['tags']))
+    total['priority'] = sorted(priorities.items())
+    total['tags'] = sorted(tags.items())
+    return total
+
+def command(todo, progname, cmd, argv, fmt='table'):
+    """Run a command line, as split by main(), against todo.
+
+    Listings are written in fmt, one of TodoRenderer.FORMATS.  Commands
+    end with sys.exit(), which the caller may catch.
+    """
+    if cmd == "template" or cmd == "tmpl":
+        cmd = argv[0]
+        argv = argv[1:]
+
+        if cmd == "add":
+            name = argv[0]
+            req = ' '.join(argv[1:])
+            todo.templateadd(name, req)
+
+        if cmd == "del" or cmd == "delete":
+            name = argv[0]
+            todo.templatedel(name)
+
+        if cmd == "show":
+            todo.templateshow(argv)
+
+        if cmd == "run":
+            name = argv[0]
+            TodoRenderer(sys.stdout, fmt).writeall(
+              todo.templateiter(name, argv[1:]))
+
+        if cmd == "materialize":
+            name = argv[0]
+            todo.templatematerialize(name, argv[1:])
+
+        if cmd == "unmaterialize":
+            name = argv[0]
+            todo.templateunmaterialize(name)
+
+        if cmd == "refresh":
+            full = len(argv) > 0 and argv[-1] == "full"
+            if full:
+                argv = argv[:-1]
+            name = argv[0] if len(argv) > 0 else None
+            todo.templaterefresh(name, full)
+
+        if cmd == "materialized":
+            todo.templatematerialized()
+
+        sys.exit(0)
+
+    if cmd == "import":
+        if len(argv) == 0 or argv[0] == '-':
+            f = sys.stdin
+        else:
+            f = open(argv[0], 'r')
+        dates = DateParser()
+        items = [parseImportLine(line, dates) for line in f
+          if len(line.strip()) > 0]
+        print len(todo.add_many(items))
+        sys.exit(0)
+
+    if cmd == "tags":
+        for name, uses in todo.tags():
+            print "%6d %s" % (uses, name)
+        sys.exit(0)
+
+    if cmd == "stats":
+        printStats(todo.stats())
+        sys.exit(0)
+
+    if cmd == "maintain":
+        full = False
+        for arg in argv:
+            if arg.startswith("every="):
+                todo.setmaintain(int(arg[6:]))
+            elif arg == "full":
+                full = True
+            else:
+                raise ValueError("Usage: maintain [full] [every=n]")
+        report = todo.maintain(True, full)
+        print "Integrity: %s" % '; '.join(report['integrity'])
+        print "Pages:     %d of %d bytes, %d free, %d released" % \
+          (report['page_count'], report['page_size'],
+            report['freelist_count'], report['vacuumed'])
+        if report['auto_vacuum'] != 2:
+            print "           (no incremental auto_vacuum on this database)"
+        for name, size in report['sizes'] or ():
+            print "  %10d %s" % (size, name)
+        sys.exit(0)
+
+    if cmd == "compact":
+        by = 'month'
+        drop = None
+        for arg in argv:
+            if arg.startswith("drop="):
+                drop = arg[5:]
+            else:
+                by = arg
+        print "%d moved, %d merged, %d dropped" % todo.compact(by, drop)
+        sys.exit(0)
+
+    if cmd == "export":
+        since = 0
+        if len(argv) == 2 and argv[0] == "--since":
+            since = int(argv[1])
+        elif len(argv) > 0:
+            raise ValueError("Usage: export [--since seq]")
+        for change in todo.export(since):
+            print json.dumps(change)
+        sys.exit(0)
+
+    if cmd == "apply":
+        if len(argv) == 0 or argv[0] == '-':
+            f = sys.stdin
+        else:
+            f = open(argv[0], 'r')
+        seq = todo.apply(json.loads(line) for line in f
+          if len(line.strip()) > 0)
+        if seq is not None:
+            print seq
+        sys.exit(0)
+
+    if cmd == "sql":
+        query = " ".join(argv)
+        TodoRenderer(sys.stdout, fmt).writeall(todo.iter_raw(query))
+        sys.exit(0)
+
+    if cmd == "explain":
+        cmd = argv[0]
+        argv = argv[1:]
+        if cmd == "sql":
+            plan = todo.explain_raw(" ".join(argv))
+        elif cmd == "template" or cmd == "tmpl":
+            plan = todo.templateexplain(argv[0], argv[1:])
+        elif cmd == 'get' or cmd == 'print' or cmd == 'list':
+            item, title, tags, untags = parseProperties(argv)
+            title, paging = parsePaging(title)
+            if len(title) > 0:
+                item.title.set(' '.join(title))
+            if len(tags) > 0:
+                item.tags.set(tags)
+            plan = todo.explain(item, **paging)
+        else:
+            raise ValueError("Cannot explain: %s" % cmd)
+        for line in plan:
+            print line
+        sys.exit(0)
+
+    item, title, tags, untags = parseProperties(argv)
+
+    if cmd == 'add' or cmd == 'insert':
+        item.tags.set(tags)
+        if len(title) == 0:
+            raise ValueError("Empty title")
+        item.title.set(' '.join(title))
+        print todo.add(item)
+        sys.exit(0)
+
+    if cmd == 'update' or cmd == 'set':
+        selection = None
+        # Unlike "set", "--set" cannot be meant as a word of the title.
+        if "--set" in argv:
+            selection = argv[0:argv.index("--set")]
+            item, title, tags, untags = \
+              parseProperties(argv[argv.index("--set") + 1:])
+
+        tagsintersect = tags & untags
+        if len(tagsintersect) != 0:
+            raise ValueError("Tags & untags intersect: %s" % \
+              ', '.join(tagsintersect))
+
+        if selection is not None:
+            if len(title) > 0:
+                item.title.set(' '.join(title))
+            if len(selection) > 0 and selection[0] == "where":
+                print todo.update_raw(item, ' '.join(selection), [], tags,
+                  untags)
+                sys.exit(0)
+            ids, words = parseIds(selection)
+            selitem, words, seltags, seluntags = parseProperties(words)
+            if len(words) > 0:
+                selitem.title.set(' '.join(words))
+            if len(seltags) > 0:
+                selitem.tags.set(seltags)
+            print todo.update_many(item, ids, selitem, tags, untags)
+            sys.exit(0)
+
+        rowid = title[0]
+        title = title[1:]
+
+        curitem = todo.get_id(rowid)
+        if curitem is None:
+            raise ValueError("No such item: %s" % rowid)
+
+        if len(title) > 0:
+            item.title.set(' '.join(title))
+        curitem.update(item)
+        if len(tags) > 0:
+            curitem.tags.add(tags)
+        if len(untags) > 0:
+            curitem.tags.delete(untags)
+ 
+        todo.update(curitem)
+        sys.exit(0)
+        
+    if cmd == 'get' or cmd == 'print' or cmd == 'list':
+        title, paging = parsePaging(title)
+        if len(title) > 0:
+            item.title.set(' '.join(title))
+        if len(tags) > 0:
+            item.tags.set(tags)
+
+        out = TodoRenderer(sys.stdout, fmt)
+        count = 0
+        ritem = None
+        for ritem in todo.iter(item, **paging):
+            out.write(ritem)
+            count += 1
+        out.flush()
+        if paging.get('limit') and count == paging['limit']:
+            print >>sys.stderr, "-- next page: after=%s" % \
+              TodoDatabase.pagecursor(ritem, paging.get('order'))
+        sys.exit(0)
+
+    if cmd == 'history':
+        start = None
+        end = None
+        words = []
+        for word in title:
+            if word.startswith("from="):
+                start = word[5:]
+            elif word.startswith("to="):
+                end = word[3:]
+            else:
+                words.append(word)
+        if len(words) > 0:
+            item.title.set(' '.join(words))
+        if len(tags) > 0:
+            item.tags.set(tags)
+        TodoRenderer(sys.stdout, fmt).writeall(
+          todo.iterhistory(item, start, end))
+        sys.exit(0)
+
+    if cmd == 'search':
+        if len(title) == 0:
+            raise ValueError("Nothing to search for")
+        TodoRenderer(sys.stdout, fmt).writeall(todo.search(title))
+        sys.exit(0)
+
+    if cmd == 'del' or cmd == 'delete' or cmd == 'rem' or cmd == 'remove':
+        if len(argv) > 0 and argv[0] == "where":
+            print todo.delete_raw(' '.join(argv))
+            sys.exit(0)
+
+        ids, words = parseIds(title)
+        if len(words) > 0:
+            item.title.set(' '.join(words))
+        if len(tags) > 0:
+            item.tags.set(tags)
+
+        print todo.delete(ids, item)
+        sys.exit(0)
+
+    if cmd == 'edit':
+        # Only needed here, spare the import to every other command.
+        import subprocess
+        import tempfile
+
+        rowid = title[0]
+
+        curitem = todo.get_id(rowid)
+        if curitem is None:
+            raise ValueError("No such item: %s" % rowid)
+        f, fname = tempfile.mkstemp()
+        f = os.fdopen(f, "w")
+        f.write(curitem.description.get() or "")
+        f.close()
+        editor = os.environ.get("EDITOR") or "/bin/vi"
+        mtime0 = os.stat(fname).st_mtime
+        subprocess.call("%s %s" % (editor, fname), shell=True)
+
+        mtime1 = os.stat(fname).st_mtime
+        if mtime0 == mtime1:
+            print "No changes."
+            os.unlink(fname)
+            sys.exit(0)
+        f = open(fname, 'r')
+        description = f.read()
+        f.close()
+        os.unlink(fname)
+        curitem.description.set(description)
+        todo.update(curitem)
+        sys.exit(0)
+
+    print "ERROR: Unknown command: %s" % cmd
+    usage(progname)
+
+
+class SocketOutput(object):
+    """File-like object sending what is written as framed chunks.
+
+    Each chunk is a header line made of the kind of output ('o' for
+    stdout, 'e' for stderr, 'x' for the exit status) immediately followed
+    by the length of the data, then the data itself.
+    """
+
+    BUFSIZE = 16384
+
+    def __init__(self, wfile, kind):
+        self._wfile = wfile
+        self._kind = kind
+        self._buf = []
+        self._size = 0
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buf.append(data)
+        self._size += len(data)
+        if self._size >= SocketOutput.BUFSIZE:
+            self.flush()
+
+    def flush(self):
+        if self._size == 0:
+            return
+        data = ''.join(self._buf)
+        self._buf = []
+        self._size = 0
+        self._wfile.write("%s%d\n" % (self._kind, len(data)))
+        self._wfile.write(data)
+        self._wfile.flush()
+
+def serve(todo, sockfile):
+    """Run the commands received on sockfile, one client at a time.
+
+    A client sends one JSON line holding progname, cmd and argv, and
+    receives its output as SocketOutput chunks, ended by an 'x' chunk
+    holding the exit status.
+    """
+    if os.path.exists(sockfile):
+        os.unlink(sockfile)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sockfile)
+    server.listen(16)
+    # A client going away must not kill us.
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+    # Not sys.exit(), as serveClient() catches the SystemExit of commands.
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            conn, addr = server.accept()
+            try:
+                serveClient(todo, conn)
+            except socket.error:
+                pass
+            except Exception:
+                # Nor a request we cannot make sense of.
+                traceback.print_exc()
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(sockfile)
+
+def serveClient(todo, conn):
+    rfile = conn.makefile('r')
+    wfile = conn.makefile('w')
+    request = json.loads(rfile.readline())
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = SocketOutput(wfile, 'o')
+    sys.stderr = SocketOutput(wfile, 'e')
+    status = 0
+    try:
+        command(todo, request['progname'], request['cmd'].encode('utf-8'),
+          [arg.encode('utf-8') for arg in request['argv']],
+          request.get('format', 'table'))
+    except SystemExit as e:
+        status = e.code or 0
+    except socket.error:
+        raise
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        out, err = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+    out.flush()
+    err.flush()
+    exitstatus = SocketOutput(wfile, 'x')
+    exitstatus.write(str(status))
+    exitstatus.flush()
+    wfile.flush()
+    wfile.close()
+
+def expandDbFiles(patterns, existing=False):
+    """Return the database files given by -d, expanding glob patterns.
+
+    A pattern matching nothing is kept as is, so that the database gets
+    created, unless existing is set: that is a ValueError instead.
+    Sockets, journals and archive partitions are skipped.
+    """
+    partition = TodoDatabase.PARTITION_SUFFIX % ''
+    dbfiles = []
+    for pattern in patterns:
+        matches = sorted(path for path in glob.glob(pattern)
+          if not path.endswith(MULTI_EXCLUDES) and
+            partition not in os.path.basename(path))
+        if len(matches) == 0 and existing:
+            raise ValueError("No such database: %s" % pattern)
+        for path in matches or [pattern]:
+            if path not in dbfiles:
+                dbfiles.append(path)
+    return dbfiles
+
+def mergeSorted(streams, key, reverse=False):
+    """Merge iterators, each sorted by key, into one sorted iterator."""
+    heads = []
+    for stream in streams:
+        for first in stream:
+            heads.append([key(first), len(heads), first, stream])
+            break
+    # The stream index breaks ties, so records are never compared.
+    pick = max if reverse else min
+    while len(heads) > 0:
+        head = pick(heads)
+        yield head[2]
+        try:
+            head[2] = next(head[3])
+            head[0] = key(head[2])
+        except StopIteration:
+            heads.remove(head)
+
+def queryDatabases(dbfiles, query, key=None, reverse=False, readonly=True,
+  timeout=BUSY_TIMEOUT, pragmas={}):
+    """Run query(todo) against every database at once, one thread each.
+
+    Yields (dbfile, record) pairs: as they are fetched, or merged in key
+    order if key is given, which each query must follow.  The errors of
+    a database are written to stderr while the others go on; a
+    ValueError is raised at the end if any failed.  Close the generator
+    to stop the queries early.
+    """
+    end = object()
+    stop = threading.Event()
+    if key is None:
+        queues = [Queue.Queue(4 * len(dbfiles))] * len(dbfiles)
+    else:
+        queues = [Queue.Queue(4) for dbfile in dbfiles]
+
+    def send(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(index, dbfile):
+        queue = queues[index]
+        try:
+            todo = TodoDatabase(dbfile, readonly, timeout, pragmas=pragmas)
+            try:
+                batch = []
+                for record in query(todo):
+                    batch.append(record)
+                    if len(batch) >= TodoRenderer.BATCH:
+                        if not send(queue, (index, batch)):
+                            return
+                        batch = []
+                send(queue, (index, batch))
+            finally:
+                todo.close()
+        except Exception as e:
+            send(queue, (index, e))
+        send(queue, (index, end))
+
+    failed = []
+
+    def fetch(queue, running):
+        while running > 0:
+            index, batch = queue.get()
+            if batch is end:
+                running -= 1
+            elif isinstance(batch, Exception):
+                print >>sys.stderr, "%s: %s" % (dbfiles[index], batch)
+                failed.append(dbfiles[index])
+            else:
+                for record in batch:
+                    yield dbfiles[index], record
+
+    threads = [threading.Thread(target=run, args=(index, dbfile))
+      for index, dbfile in enumerate(dbfiles)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if key is None:
+        records = fetch(queues[0], len(dbfiles))
+    else:
+        records = mergeSorted([fetch(queue, 1) for queue in queues],
+          lambda (dbfile, record): key(record), reverse)
+    try:
+        for pair in records:
+            yield pair
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if len(failed) > 0:
+        raise ValueError("Failed on %d of %d databases: %s" % (len(failed),
+          len(dbfiles), ', '.join(failed)))
+
+def multiCommand(dbfiles, progname, cmd, argv, fmt='table',
+  timeout=BUSY_TIMEOUT, pragmas={}):
+    """Run a command line of MULTI_COMMANDS against all of dbfiles.
+
+    Listings are merged, each record along with its database, in the
+    requested order across them all if any, with limit= and offset=
+    applied to the merged listing.  Stats are printed for each database,
+    then summed.  Ends with sys.exit() like command().
+    """
+    readonly = True
+    key = None
+    reverse = False
+    start = 0
+    stop = None
+    if cmd == "stats":
+        query = lambda todo: [todo.stats()]
+    elif cmd == "sql":
+        querycond = " ".join(argv)
+        query = lambda todo: todo.iter_raw(querycond)
+    elif (cmd == "template" or cmd == "tmpl") and len(argv) > 1 and \
+      argv[0] == "run":
+        # Materialized templates are refreshed first.
+        readonly = False
+        query = lambda todo: todo.templateiter(argv[1], argv[2:])
+    elif cmd == 'get' or cmd == 'print' or cmd == 'list':
+        item, title, tags, untags = parseProperties(argv)
+        title, paging = parsePaging(title)
+        if len(title) > 0:
+            item.title.set(' '.join(title))
+        if len(tags) > 0:
+            item.tags.set(tags)
+        if 'after' in paging:
+            raise ValueError("after= only pages through one database")
+        order = paging.get('order')
+        if order is not None or len(paging) > 0:
+            key = lambda record: TodoDatabase.sortvalue(record, order)
+            reverse = order is not None and order[0:1] == '-'
+        # Every database may hold the whole page.
+        start = paging.pop('offset', 0)
+        if 'limit' in paging:
+            stop = start + paging['limit']
+            paging['limit'] = stop
+        query = lambda todo: todo.iter(item, **paging)
+    else:
+        raise ValueError("Cannot run on several databases: %s" % \
+          ' '.join([cmd] + argv[0:1]))
+
+    records = queryDatabases(dbfiles, query, key, reverse, readonly,
+      timeout, pragmas)
+    if cmd == "stats":
+        results = sorted(records, key=lambda (dbfile, stats):
+          dbfiles.index(dbfile))
+        for dbfile, stats in results:
+            print "== %s" % dbfile
+            printStats(stats)
+        print "== total"
+        printStats(mergeStats([stats for dbfile, stats in results]))
+        sys.exit(0)
+    out = TodoRenderer(sys.stdout, fmt, True)
+    for dbfile, record in itertools.islice(records, start, stop):
+        out.write(record, dbfile)
+    out.flush()
+    records.close()
+    sys.exit(0)
+
+def main(progname, optlist, cmd, argv):
+    """Run a command line, as split by getitdone.parseCommandLine()."""
+    dbfiles = []
+    timeout = BUSY_TIMEOUT
+    trace = None
+    fmt = 'table'
+    pragmas = parseIoProfile(os.environ.get(IO_ENVIRON) or 'default')
+    for opt, optarg in optlist:
+        if opt == '-d':
+            dbfiles.append(optarg)
+        elif opt == '-o':
+            pragmas.update(parseIoProfile(optarg))
+        elif opt == '--trace' and trace is None:
+            trace = False
+        elif opt == '--profile':
+            trace = True
+        elif opt == '--format':
+            if optarg not in TodoRenderer.FORMATS:
+                raise ValueError("Unknown format: %s" % optarg)
+            fmt = optarg
+        elif opt == '-t':
+            timeout = float(optarg)
+        elif opt == '-h':
+            usage(progname)
+            sys.exit(0)
+
+    if cmd == "help":
+        usage(progname)
+        sys.exit(0)
+
+    if cmd == "schema":
+        print "You can run a where query against this table:"
+        print TodoDatabase.SQL_JOIN_QUERY
+        sys.exit(0)
+
+    os.umask(0077)
+    # Listings are streamed; let "| head" and the like cut them short.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    readonly = cmd in READONLY_COMMANDS
+    if (cmd == "template" or cmd == "tmpl") and len(argv) > 0:
+        readonly = argv[0] in READONLY_TEMPLATE_COMMANDS
+    # Querying a database which is not there would create it empty.
+    dbfiles = expandDbFiles(dbfiles, readonly) or [DB_FILE]
+    if len(dbfiles) > 1:
+        if cmd not in MULTI_COMMANDS:
+            raise ValueError("Cannot run on several databases: %s" % cmd)
+        multiCommand(dbfiles, progname, cmd, argv, fmt, timeout, pragmas)
+    dbfile = dbfiles[0]
+
+    todo = TodoDatabase(dbfile, readonly, timeout, pragmas=pragmas)
+    if trace is not None:
+        todo.settrace(printTrace, trace)
+
+    if cmd == "serve":
+        serve(todo, dbfile + SOCKET_SUFFIX)
+        sys.exit(0)
+
+    command(todo, progname, cmd, argv, fmt)